@@ -16,8 +16,9 @@ from curses import wrapper
 
 from zmachine.interpreter import Story,Interpreter,OutputStream,OutputStreams,Memory,QuitException,\
                                  StoryFileException,InterpreterException,MemoryAccessException,\
-                                 InputStreams,InputStream,RestartException
+                                 InputStreams,InputStream
 from zmachine.text import ZTextException
+from zmachine.chunkstore import FileChunkStore
 from zmachine.memory import BitArray,MemoryException
 from zmachine.instructions import InstructionException
 
@@ -174,6 +175,11 @@ class Terp(object):
 	            self.run()
 
 class SaveRestoreMixin(object):
+    CHUNKS_DIRECTORY = 'chunks' # Directory under the save path holding the memory pages of every save
+
+    def chunk_store(self):
+        return FileChunkStore(os.path.join(self.save_path,SaveRestoreMixin.CHUNKS_DIRECTORY))
+
     def fix_filename(self, filename):
         """ Take a provided filename, strip any unwanted characters, then prefix with our story file name """
         return u'%s_%s.sav' % (self.terp.story_filename,
@@ -191,8 +197,8 @@ class TerpSaveHandler(SaveRestoreMixin):
 
         try:
             self.success_action.apply(interpreter)
-            with open(os.path.join(self.save_path,filename),'w') as f:
-                f.write(json.dumps(interpreter.to_save_data()))
+            with open(os.path.join(self.save_path,filename),'wb') as f:
+                f.write(interpreter.to_chunked_save_data(self.chunk_store()))
             message = '\nSaved to %s' % filename
         except Exception as e:
             message = '\nError saving. %s' % (e,)
@@ -217,8 +223,8 @@ class TerpRestoreHandler(SaveRestoreMixin):
         filename = self.fix_filename(filename)
 
         try:
-            with open(os.path.join(self.save_path,filename),'r') as f:
-                interpreter.restore_from_save_data(f.read())
+            with open(os.path.join(self.save_path,filename),'rb') as f:
+                interpreter.restore_from_save_data(f.read(),chunk_store=self.chunk_store())
             message = '\nRestored from %s' % filename
         except Exception as e:
             message = '\nError restoring. %s' % (e,)
@@ -343,7 +349,7 @@ class MainLoop(object):
                     self.zmachine.output_streams.flush()
 
                 story.refresh()
-            except (QuitException,RestartException) as e:
+            except QuitException as e:
                 self.zmachine.output_streams.flush()
                 raise e
             except FileStreamEmptyException:
@@ -351,24 +357,24 @@ class MainLoop(object):
             except Exception as e:
                 raise Exception('Unhandled exception "%s" at PC 0x%04x [%s]' % (e,self.zmachine.pc,self.zmachine.last_instruction),e)
 
-def load_zmachine(filename,restart_flags=None):
+def load_zmachine(filename):
     with open(filename,'rb') as f:
         story = Story(f.read())
         outputs = OutputStreams(OutputStream(),OutputStream())
         inputs = InputStreams(InputStream(),InputStream())
         zmachine = Interpreter(story,outputs,inputs,None,None)
-        zmachine.reset(restart_flags=restart_flags)
+        zmachine.reset()
         zmachine.story.header.set_debug_mode()
 
     return zmachine
 
 
-def start(path,commands_path,trace_file_path=None,seed=None,restart_flags=None,transcript_path=None,save_path=None):
+def start(path,commands_path,trace_file_path=None,seed=None,transcript_path=None,save_path=None):
     tracer = None
     if trace_file_path:
         tracer = Tracer()
 
-    zmachine = load_zmachine(path,restart_flags)
+    zmachine = load_zmachine(path)
     story_path, story_filename = os.path.split(path)        
     loop = MainLoop(zmachine,
         story_filename=story_filename,
@@ -400,18 +406,13 @@ def main(*args):
     data = parser.parse_args()
 
     try:
-        restart_flags = None # Per spec, when restarting, preserve bit 0 and bit 1 of flag 2 in header 
-        while True:
-            try:
-                start(data.story,
-                    commands_path=data.commands_path,
-                    trace_file_path=data.trace_file,
-                    seed=data.seed,
-                    transcript_path=data.transcript_path,
-                    save_path=data.save_path,
-                    restart_flags=restart_flags)    
-            except RestartException as e:
-                restart_flags = e.restart_flags
+        # Restarts are handled by the interpreter in place, so the story only needs to be started once
+        start(data.story,
+            commands_path=data.commands_path,
+            trace_file_path=data.trace_file,
+            seed=data.seed,
+            transcript_path=data.transcript_path,
+            save_path=data.save_path)
     except QuitException:
 
         print("Thanks for playing!")
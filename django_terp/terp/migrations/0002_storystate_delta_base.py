@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storystate',
+            name='delta_base',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='terp.StoryState'),
+        ),
+    ]
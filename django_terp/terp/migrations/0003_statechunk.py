@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terp', '0002_storystate_delta_base'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateChunk',
+            fields=[
+                ('digest', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
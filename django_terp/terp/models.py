@@ -1,25 +1,93 @@
+import base64
 import hashlib
 import os
 import random
 import time
 import json
 
-from django.db import models
+from django.db import models,transaction,IntegrityError
 from django.conf import settings
 
 from zmachine.interpreter import Story, Interpreter,OutputStream,OutputStreams,Memory,QuitException,\
                                  StoryFileException,InterpreterException,MemoryAccessException,\
-                                 InputStreams,InputStream,RestartException
+                                 InputStreams,InputStream
 from zmachine.text import ZTextException
+from zmachine.savedata import save_dynamic_memory,SaveDataException
+from zmachine.chunkstore import ChunkStore,chunk_digest
 from zmachine.memory import BitArray,MemoryException
 from zmachine.instructions import InstructionException
 
+from terp.pool import InterpreterPool,WarmInterpreter
+from terp.storycache import StoryCache
+from terp.movecache import MoveCache
+
+# Live interpreters for recently played sessions. Size can be set with TERP_INTERPRETER_POOL_SIZE
+interpreter_pool = InterpreterPool(getattr(settings,'TERP_INTERPRETER_POOL_SIZE',InterpreterPool.DEFAULT_SIZE))
+
+# Parsed stories that interpreters are forked from. Size can be set with TERP_STORY_CACHE_SIZE
+story_cache = StoryCache(getattr(settings,'TERP_STORY_CACHE_SIZE',StoryCache.DEFAULT_SIZE))
+
+# Moves already played by any session. Bounds can be set with TERP_MOVE_CACHE_SIZE/TERP_MOVE_CACHE_BYTES
+move_cache = MoveCache(getattr(settings,'TERP_MOVE_CACHE_SIZE',MoveCache.DEFAULT_SIZE),
+                       getattr(settings,'TERP_MOVE_CACHE_BYTES',MoveCache.DEFAULT_MAX_BYTES))
+
+def encode_state(zmachine,base_memory=None):
+    """ Return save data for a StoryState, base64 encoded for the text field. If base_memory is passed, the save is
+        a delta against it. Otherwise it is a chunked save, with its pages in StateChunk """
+    if base_memory is None:
+        data = zmachine.to_chunked_save_data(DatabaseChunkStore())
+    else:
+        data = zmachine.to_delta_save_data(base_memory)
+    return base64.b64encode(data).decode('ascii')
+
+def decode_state(state):
+    """ Return the save data in a StoryState's state field. Older states are stored as JSON """
+    if state.startswith('{'):
+        return state
+    return base64.b64decode(state)
+
+class DatabaseChunkStore(ChunkStore):
+    """ Chunk store (see zmachine.chunkstore) keeping pages in StateChunk rows """
+    def __init__(self):
+        pass
+
+    def put_many(self,chunks):
+        digests = [chunk_digest(chunk) for chunk in chunks]
+        new_chunks = dict((digest.hex(),chunk) for digest,chunk in zip(digests,chunks))
+        for digest in StateChunk.objects.filter(digest__in=list(new_chunks)).values_list('digest',flat=True):
+            del new_chunks[digest]
+        try:
+            with transaction.atomic():
+                StateChunk.objects.bulk_create([StateChunk(digest=digest,data=chunk) 
+                                                for digest,chunk in new_chunks.items()])
+        except IntegrityError:
+            # Another request stored some of the same pages first
+            for digest,chunk in new_chunks.items():
+                StateChunk.objects.get_or_create(digest=digest,defaults={'data': chunk})
+        return digests
+
+    def get_many(self,digests):
+        hex_digests = [digest.hex() for digest in digests]
+        chunks = dict(StateChunk.objects.filter(digest__in=set(hex_digests)).values_list('digest','data'))
+        try:
+            return [bytes(chunks[digest]) for digest in hex_digests]
+        except KeyError:
+            raise SaveDataException('Save data refers to a missing page.')
+
+    def __len__(self):
+        return StateChunk.objects.count()
+
 def get_default_user():
     from django.contrib.auth.models import User
     user,created = User.objects.get_or_create(username=settings.DEFAULT_USER_USERNAME)
     return user
 
 class StoryManager(models.Manager):
+    def get_queryset(self):
+        # Story data is large and only needed to parse a story that isn't cached yet (see StoryCache),
+        # so it is loaded on first access
+        return super(StoryManager,self).get_queryset().defer('data')
+
     def get_or_create_from_path(self, path, title):
         """ Given a path to a story file, hash it, create new story 
             if does not exist, return existing if it does """
@@ -144,14 +212,56 @@ class BufferOutputStream(OutputStream):
 
         self.score = right_string
 
+def attach_streams(zmachine):
+    """ Give zmachine the streams the web terp uses, returning a WarmInterpreter for it (not yet at a state) """
+    zmachine.output_streams = OutputStreams(OutputStream(),OutputStream())
+    zmachine.output_streams.reset(zmachine,zmachine.get_ztext())
+    zmachine.input_streams = InputStreams(InputStream(),InputStream())
+    zmachine.input_streams.reset()
+    
+    output_stream = BufferOutputStream()
+    input_stream =  StubInputStream()
+    zmachine.output_streams.set_screen_stream(output_stream)
+    zmachine.input_streams.keyboard_stream = input_stream
+    zmachine.input_streams.select_stream(InputStreams.KEYBOARD)
+    input_stream.waiting_for_line = False
+    input_stream.command = None
+    return WarmInterpreter(zmachine,output_stream,input_stream,None,None)
+
+def run_until_input(zmachine):
+    """ Run until the zmachine waits for input (or stops) """
+    start_time = time.time()
+    while True and start_time + 5 >= time.time(): # If execution goes more than 5 seconds, cancel.
+        if zmachine.step() != Interpreter.RUNNING_STATE:
+            break
+
+def run_opening(zmachine):
+    """ Run a story from the start to its first prompt (see StoryCache.get_opening). Return the text, score
+        and room name it output """
+    warm = attach_streams(zmachine)
+    run_until_input(zmachine)
+    return warm.output_stream.buffer,warm.output_stream.score,warm.output_stream.room_name
+
+class StateChunk(models.Model):
+    """ A page of dynamic memory, stored once however many StoryStates' saves contain it """
+    digest = models.CharField(max_length=40,primary_key=True) # Hex SHA-1 of the data
+    data = models.BinaryField()
+
 class StoryState(models.Model):
     """ A specific state in the timeline for a given story session """
+    # Every this many moves the full state is stored. Other moves only store changes from the previous
+    # state, which bounds the number of deltas applied to restore a state
+    KEYFRAME_INTERVAL = 20
+
     session = models.ForeignKey(StorySession)
     move = models.PositiveIntegerField() # Move number
 
     # When we branch, we store the state we branched from. State data all immutable
     branch_parent = models.ForeignKey('StoryState', null=True,blank=True)
 
+    # If set, state is a delta against the state of this StoryState. Otherwise it is a full save
+    delta_base = models.ForeignKey('StoryState', null=True,blank=True,related_name='+')
+
     state = models.TextField() # Saved state at start of this move
     command = models.CharField(max_length=1000) # Command that led to this state
     text = models.TextField() # Text output by this command
@@ -161,46 +271,98 @@ class StoryState(models.Model):
 
     def generate_next_state(self,command=None):
         """ Starting from this state and with the given command, create a new StoryState object
-            after running the zmachine """
-        story = Story(self.session.story.data)
-        outputs = OutputStreams(OutputStream(),OutputStream())
-        inputs = InputStreams(InputStream(),InputStream())
-        zmachine = Interpreter(story,outputs,inputs,None,None)
-        zmachine.reset(restart_flags=None)
-        zmachine.story.header.set_debug_mode()
-        zmachine.story.rng.enter_predictable_mode(self.session.rng_seed)
-        
-        output_stream = BufferOutputStream()
-        input_stream =  StubInputStream(story)
-        zmachine.output_streams.set_screen_stream(output_stream)
-        zmachine.input_streams.keyboard_stream = input_stream
-        zmachine.input_streams.select_stream(InputStreams.KEYBOARD)
-        input_stream.waiting_for_line = False
-        input_stream.command = None
-        
-        output_stream.reset()
-        if self.move > 0:
-           zmachine.restore_from_save_data(self.state)
-           input_stream.command = command
-           zmachine.read_and_process(zmachine._text_buffer_addr,zmachine._parse_buffer_addr)
-        
-        start_time = time.time()
-        while True and start_time + 5 >= time.time(): # If execution goes more than 5 seconds, cancel.
-            if zmachine.step() != Interpreter.RUNNING_STATE:
-                break
+            after running the zmachine. If the session's zmachine is still live in this process (at this
+            state), it is reused rather than rebuilt. The first move starts from the story's cached opening """
+        base_memory = None
+        if self.move == 0:
+            story_record = StoryRecord.objects.get(pk=self.session.story_id)
+            zmachine,(text,score,room_name) = story_cache.get_opening(story_record,self.session.rng_seed,run_opening)
+            warm = attach_streams(zmachine)
+            warm.output_stream.buffer,warm.output_stream.score,warm.output_stream.room_name = text,score,room_name
+        else:
+            warm = interpreter_pool.checkout(self.session_id,self.id)
+            if warm is None:
+                warm = self.load_interpreter()
+            zmachine = warm.zmachine
+            # Every move starts from the session's seed, so a move's output doesn't depend on whether the
+            # interpreter was kept in the pool or restored from the database
+            zmachine.story.rng.enter_predictable_mode(self.session.rng_seed)
+            warm.output_stream.reset()
+            # The next state is stored as changes from the memory saved in this one
+            base_memory = warm.memory
+            self.run_command(warm,MoveCache.normalize_command(command))
+        output_stream = warm.output_stream
         
-        state_data = json.dumps(zmachine.to_save_data())
+        if base_memory is None or (self.move+1) % StoryState.KEYFRAME_INTERVAL == 0:
+            delta_base = None
+        else:
+            delta_base = self
+        state_data = encode_state(zmachine,base_memory if delta_base else None)
 
         state = StoryState.objects.create(session=self.session,
             move=self.move+1,
             branch_parent=self.branch_parent,
+            delta_base=delta_base,
             state=state_data,
             command=command or '',
             text=output_stream.buffer,
             score=output_stream.score,
             room_name=output_stream.room_name)
 
+        warm.state_id = state.id
+        warm.memory = zmachine.dynamic_memory()
+        interpreter_pool.checkin(self.session_id,warm)
+
         return state
 
+    def run_command(self,warm,command):
+        """ Run command on a WarmInterpreter. If any session already ran it from the same state, the
+            result is restored from the move cache instead """
+        zmachine = warm.zmachine
+        output_stream = warm.output_stream
+        key = move_cache.key(zmachine,command)
+        move = move_cache.get(key)
+        if move:
+            save_data,output_stream.buffer,output_stream.score,output_stream.room_name = move
+            zmachine.restore_from_save_data(save_data)
+            return
+
+        rng_usage = zmachine.story.rng.usage()
+        warm.input_stream.command = command
+        zmachine.read_and_process(zmachine._text_buffer_addr,zmachine._parse_buffer_addr)
+        run_until_input(zmachine)
+        move_cache.put(key,zmachine,output_stream.buffer,output_stream.score,output_stream.room_name,rng_usage)
+
+    def load_interpreter(self):
+        """ Return a WarmInterpreter for a new zmachine restored to this state """
+        story_record = StoryRecord.objects.get(pk=self.session.story_id)
+        zmachine = story_cache.get(story_record).fork()
+        warm = attach_streams(zmachine)
+
+        story_data = zmachine.story.story_data
+        chunk_store = DatabaseChunkStore()
+        save_data,delta_base_memory = self.get_save_data(story_data,chunk_store)
+        zmachine.restore_from_save_data(save_data,base_memory=delta_base_memory,chunk_store=chunk_store)
+        warm.state_id = self.id
+        warm.memory = bytes(save_dynamic_memory(save_data,story_data,delta_base_memory,chunk_store))
+        return warm
+
+    def get_save_data(self,story_data,chunk_store):
+        """ Return the save data for this state, and the dynamic memory of the state it is a delta against
+            (None if it is a full save). Memory is rebuilt from the most recent full save, reading the pages
+            of chunked saves from chunk_store """
+        chain = []
+        state = self
+        while state.delta_base_id:
+            chain.append(state)
+            state = state.delta_base
+        if not chain:
+            return decode_state(self.state),None
+
+        memory = save_dynamic_memory(decode_state(state.state),story_data,chunk_store=chunk_store)
+        for delta in reversed(chain[1:]):
+            memory = save_dynamic_memory(decode_state(delta.state),story_data,memory)
+        return decode_state(self.state),bytes(memory)
+
     def __str__(self):
         return '%s/%s/%s' % (self.move, self.score, self.room_name)
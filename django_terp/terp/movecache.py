@@ -0,0 +1,65 @@
+""" Process-wide memo of moves, shared by every session.
+
+    Many sessions play the same openings, so the same command is often run from the same state. The cache maps a
+    hash of the zmachine's state (memory, stack and pc) plus the command to the save data of the state it led
+    to, and the text and status line it output. Moves that used the RNG are never cached, since their result
+    depends on the session's seed.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+class MoveCache(object):
+    """ Least recently used memo of moves, bounded by entry count and by the total size of the save data """
+    DEFAULT_SIZE = 5000
+    DEFAULT_MAX_BYTES = 50*1024*1024
+
+    def __init__(self,max_size=DEFAULT_SIZE,max_bytes=DEFAULT_MAX_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._moves = OrderedDict() # key -> (save data,text,score,room name)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_command(command):
+        """ Return command lowercased (as the zmachine reads it) with whitespace collapsed. Commands should be
+            normalized before they are run, so that commands with the same key have the same result """
+        return ' '.join((command or '').lower().split())
+
+    def key(self,zmachine,command):
+        """ Return the key for running command (normalized) from zmachine's current state """
+        state = hashlib.sha1(zmachine.to_binary_save_data()).hexdigest()
+        return (zmachine.story.story_hash,state,command)
+
+    def get(self,key):
+        """ Return (save data,text,score,room name) for the move, or None """
+        with self._lock:
+            move = self._moves.get(key)
+            if move is None:
+                self.misses += 1
+                return None
+            self._moves.move_to_end(key)
+            self.hits += 1
+            return move
+
+    def put(self,key,zmachine,text,score,room_name,rng_usage):
+        """ Store the move that led from key to zmachine's current state. rng_usage is the RNG's usage() before
+            the move: if the move drew from or reseeded the RNG (even with the same seed), it isn't stored """
+        if zmachine.story.rng.usage() != rng_usage:
+            return
+        move = (zmachine.to_binary_save_data(),text,score,room_name)
+        with self._lock:
+            old_move = self._moves.pop(key,None)
+            if old_move:
+                self._bytes -= len(old_move[0])
+            self._moves[key] = move
+            self._bytes += len(move[0])
+            while self._moves and (len(self._moves) > self.max_size or self._bytes > self.max_bytes):
+                evicted_key,evicted_move = self._moves.popitem(last=False)
+                self._bytes -= len(evicted_move[0])
+
+    def __len__(self):
+        return len(self._moves)
@@ -0,0 +1,51 @@
+""" Per-process pool of live interpreters, so a move for a session that is already loaded just runs the
+    turn instead of rebuilding the zmachine from the database.
+
+    Every move is still saved as a StoryState, so the database stays the source of truth. An interpreter is
+    only reused if it is at the exact state the move starts from, and evicting one just drops it.
+"""
+import threading
+from collections import OrderedDict
+
+class WarmInterpreter(object):
+    """ A live zmachine with the streams the web terp attached to it, and the StoryState it is at """
+    def __init__(self,zmachine,output_stream,input_stream,state_id,memory):
+        self.zmachine = zmachine
+        self.output_stream = output_stream
+        self.input_stream = input_stream
+        self.state_id = state_id # Id of the StoryState the zmachine is at
+        self.memory = memory # Dynamic memory saved with that state, which the next delta is stored against
+
+class InterpreterPool(object):
+    """ Least recently used pool of WarmInterpreters keyed by session id """
+    DEFAULT_SIZE = 20
+
+    def __init__(self,max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self._interpreters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def checkout(self,session_id,state_id):
+        """ Remove and return the interpreter for session_id if it is at state_id, otherwise None. Until it is
+            checked back in, other requests for the session load their own """
+        with self._lock:
+            warm = self._interpreters.pop(session_id,None)
+        if warm and warm.state_id == state_id:
+            return warm
+        return None
+
+    def checkin(self,session_id,warm):
+        """ Return an interpreter to the pool, evicting the least recently used if the pool is full """
+        with self._lock:
+            self._interpreters[session_id] = warm
+            self._interpreters.move_to_end(session_id)
+            while len(self._interpreters) > self.max_size:
+                self._interpreters.popitem(last=False)
+
+    def discard(self,session_id):
+        """ Drop the interpreter for session_id, if there is one """
+        with self._lock:
+            self._interpreters.pop(session_id,None)
+
+    def __len__(self):
+        return len(self._interpreters)
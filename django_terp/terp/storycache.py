@@ -0,0 +1,83 @@
+""" Process-wide cache of parsed stories, keyed by story hash.
+
+    Each entry is a freshly reset interpreter for the story. Interpreters for sessions are forked from it, so they
+    share its parsed header values, dictionary index, abbreviations and decoded instructions, and the story
+    data only has to be loaded from the database once per process.
+
+    The cache also keeps each story's opening: an interpreter already run through the intro to the first
+    prompt, so new sessions start there. If the intro uses the RNG the opening depends on the session's seed,
+    and is kept per seed. Otherwise one opening is shared by every seed.
+"""
+import threading
+from collections import OrderedDict
+
+from zmachine.interpreter import Story,Interpreter
+
+class StoryCache(object):
+    """ Least recently used cache of reset interpreters, one per story """
+    DEFAULT_SIZE = 10
+    MAX_OPENINGS = 50 # Openings kept per story, when they depend on the seed
+
+    def __init__(self,max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self._interpreters = OrderedDict()
+        self._openings = {} # story hash -> {seed (None if the opening doesn't depend on it) -> (zmachine,result)}
+        self._lock = threading.Lock()
+
+    def get(self,story_record):
+        """ Return the reset interpreter for story_record (a StoryRecord), loading it on first use. Only
+            story_hash is read unless the story isn't cached yet, so the record can be loaded with data
+            deferred. Fork the interpreter rather than running it """
+        story_hash = story_record.story_hash
+        with self._lock:
+            zmachine = self._interpreters.get(story_hash)
+            if zmachine:
+                self._interpreters.move_to_end(story_hash)
+                return zmachine
+
+        zmachine = Interpreter(Story(bytes(story_record.data)),None,None,None,None)
+        zmachine.reset()
+        zmachine.story.header.set_debug_mode()
+
+        with self._lock:
+            self._interpreters[story_hash] = zmachine
+            while len(self._interpreters) > self.max_size:
+                evicted_hash,evicted_zmachine = self._interpreters.popitem(last=False)
+                self._openings.pop(evicted_hash,None)
+        return zmachine
+
+    def get_opening(self,story_record,seed,run_f):
+        """ Return a new interpreter at the first prompt of story_record, as it would be after running from the
+            start with the RNG in predictable mode with seed, along with the value run_f returned. 
+
+            The first time a story (or seed) is seen, run_f(zmachine) is called with a fork of the story's
+            interpreter to run it to the first prompt. Whatever it returns (such as the intro text) is cached
+            with the interpreter """
+        template = self.get(story_record) # Caches the story, so its openings are kept
+        story_hash = story_record.story_hash
+        with self._lock:
+            openings = self._openings.setdefault(story_hash,{})
+            opening = openings.get(None) or openings.get(seed)
+        if opening is None:
+            zmachine = template.fork()
+            rng = zmachine.story.rng
+            rng.enter_predictable_mode(seed)
+            rng_usage = rng.usage()
+            opening = (zmachine,run_f(zmachine))
+            # An opening that didn't draw from or reseed the RNG (even with the same seed) is the same for any seed
+            shared = rng.usage() == rng_usage
+            with self._lock:
+                openings[None if shared else seed] = opening
+                while len(openings) > StoryCache.MAX_OPENINGS:
+                    del openings[next(iter(openings))]
+        else:
+            shared = opening is openings.get(None)
+
+        zmachine,result = opening
+        session_zmachine = zmachine.fork()
+        if shared:
+            session_zmachine.story.rng.enter_predictable_mode(seed)
+        return session_zmachine,result
+
+    def __len__(self):
+        return len(self._interpreters)
@@ -1,3 +1,87 @@
-from django.test import TestCase
+import os
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase,TestCase
+
+from zmachine.interpreter import RNG
+from terp.movecache import MoveCache
+from terp.models import StoryRecord,StoryState
+
+class StubStory(object):
+    def __init__(self):
+        self.rng = RNG()
+        self.story_hash = 'story'
+
+class StubZMachine(object):
+    """ Just enough of an Interpreter for MoveCache """
+    def __init__(self):
+        self.story = StubStory()
+        self.save_data = b'state'
+
+    def to_binary_save_data(self):
+        return self.save_data
+
+class MoveCacheTests(SimpleTestCase):
+    def test_put_and_get(self):
+        cache = MoveCache()
+        zmachine = StubZMachine()
+        key = cache.key(zmachine,MoveCache.normalize_command('  Look  AROUND '))
+        self.assertEqual('look around',key[2])
+        self.assertEqual(None,cache.get(key))
+
+        rng_usage = zmachine.story.rng.usage()
+        zmachine.save_data = b'next state'
+        cache.put(key,zmachine,'text','score','room',rng_usage)
+        self.assertEqual((b'next state','text','score','room'),cache.get(key))
+
+    def test_rng_moves_not_stored(self):
+        cache = MoveCache()
+        zmachine = StubZMachine()
+        rng = zmachine.story.rng
+        rng.enter_predictable_mode(5)
+        key = cache.key(zmachine,'wait')
+
+        rng_usage = rng.usage()
+        rng.randint(10)
+        cache.put(key,zmachine,'text','score','room',rng_usage)
+        self.assertEqual(None,cache.get(key))
+
+        # Reseeding with the same seed still makes the move depend on the RNG
+        rng_usage = rng.usage()
+        rng.enter_predictable_mode(5)
+        cache.put(key,zmachine,'text','score','room',rng_usage)
+        self.assertEqual(None,cache.get(key))
+
+    def test_eviction(self):
+        cache = MoveCache(max_size=2)
+        zmachine = StubZMachine()
+        for command in ('north','south','east'):
+            cache.put(cache.key(zmachine,command),zmachine,command,'','',zmachine.story.rng.usage())
+        self.assertEqual(2,len(cache))
+        self.assertEqual(None,cache.get(cache.key(zmachine,'north')))
+
+def run_random_command(state,warm,command):
+    """ Stands in for StoryState.run_command with a command that draws from the RNG, which the test story has none of """
+    rng = warm.zmachine.story.rng
+    warm.output_stream.buffer = ' '.join(str(rng.randint(1000)) for i in range(0,5))
+
+class StoryStateTests(TestCase):
+    def setUp(self):
+        path = os.path.join(settings.BASE_DIR,'..','testdata','test.z3')
+        self.story,created = StoryRecord.objects.get_or_create_from_path(path,'Test')
+
+    def test_pool_hit_and_miss_match(self):
+        user = User.objects.create(username='test')
+        session = self.story.get_or_start_session(user)
+        state = session.get_current_state()
+
+        with mock.patch.object(StoryState,'run_command',run_random_command):
+            state = state.generate_next_state('roll')
+            # The interpreter that ran the last move is in the pool at this state, and has already drawn from the RNG
+            hit_state = state.generate_next_state('roll')
+            # It has moved on to hit_state, so the same move is restored from the database
+            miss_state = state.generate_next_state('roll')
+
+        self.assertEqual(hit_state.text,miss_state.text)
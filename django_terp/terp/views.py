@@ -7,7 +7,7 @@ from django.shortcuts import get_object_or_404,render
 from django.http import HttpResponse
 from django.urls import reverse
 
-from terp.models import StoryRecord,StorySession,get_default_user,StoryState
+from terp.models import StoryRecord,StorySession,get_default_user,StoryState,interpreter_pool
 from terp.forms import StoryForm
 
 # How many moves back to show when loading the page
@@ -58,6 +58,7 @@ class RestartStoryView(RedirectView):
 
         # Clear old states
         session.storystate_set.all().delete()
+        interpreter_pool.discard(session.id)
 
         return reverse('play',kwargs={'session_id': session.id})
 
@@ -119,19 +119,20 @@ class ObjectsWindow(object):
         window.addstr('\n')
     
     def redraw(self,window,zmachine,height):
-        ztext = zmachine.get_ztext()
+        snapshot = zmachine.get_object_snapshot()
         obj_index = self.obj_index
-        obj = zmachine.story.object_table[obj_index]
-        zc = obj['short_name_zc']
-        self._safe_add_str('%d: %s' % (obj_index,ztext.to_ascii(zc,0,len(zc))[0]),window)
-        if obj['parent']:
-            self._safe_add_str('   child of: %d' % (obj['parent']),window)
-        if obj['child']:
-            self._safe_add_str('   child is: %d' % (obj['child']),window)
-        if obj['sibling']:
-            self._safe_add_str('   sibling is: %d' % (obj['sibling']),window)
-        for number,data in obj['properties'].items():
-            self._safe_add_str('   %s: %s' % (number,''.join(['%02x' % x for x in data['data']])),window)
+        if obj_index < 1 or obj_index > snapshot.number_of_objects:
+            return
+        self._safe_add_str('%d: %s' % (obj_index,snapshot.short_names[obj_index]),window)
+        if snapshot.parent[obj_index]:
+            self._safe_add_str('   child of: %d' % (snapshot.parent[obj_index]),window)
+        if snapshot.child[obj_index]:
+            self._safe_add_str('   child is: %d' % (snapshot.child[obj_index]),window)
+        if snapshot.sibling[obj_index]:
+            self._safe_add_str('   sibling is: %d' % (snapshot.sibling[obj_index]),window)
+        raw_data = zmachine.story.raw_data
+        for number,(address,size) in zmachine.story.object_table.get_property_index(obj_index)['properties'].items():
+            self._safe_add_str('   %s: %s' % (number,''.join(['%02x' % x for x in raw_data[address:address+size]])),window)
 
 class DictionaryWindow(object):
     def __init__(self):
@@ -268,7 +269,7 @@ class DebuggerWindow(object):
                                 'm': MemoryWindow(),
                                 'v': VariablesWindow(),
                                 'a': AbbreviationWindow(),
-                                'o': ObjectsWindow(zmachine.story.object_table.estimate_number_of_objects()),
+                                'o': ObjectsWindow(zmachine.story.object_table.number_of_objects()),
                                 'd': DictionaryWindow()}
         self.current_handler = self.window_handlers['s']
         self.window_height,self.window_width = window.getmaxyx()
@@ -5,7 +5,7 @@
 import sys
 import argparse
 from zmachine.interpreter import Interpreter,Story,StoryFileException
-from zmachine.text import ZTextException
+from zmachine.text import ZTextException,ZCharRegion
 from zmachine.memory import Memory
 from zmachine.instructions import InstructionException
 
@@ -37,12 +37,15 @@ def load(path):
             return None
     return zmachine
 
-def dump(path,abbrevs=False,dictionary=False,objects=False,instructions=False,start_address=0):
+def dump(path,abbrevs=False,dictionary=False,objects=False,instructions=False,start_address=0,strings=False,find=None):
         zmachine = load(path)
         if not zmachine:
             return
 
         header = zmachine.story.header
+        ztext = zmachine.get_ztext()
+        # Unpack all of memory to zchars once, rather than string by string
+        region = ZCharRegion(zmachine.story.raw_data)
        
         print('Version:                  %d' % (header.version))
         print('Himem address:            0x%04x' % (header.himem_address))
@@ -83,18 +86,18 @@ def dump(path,abbrevs=False,dictionary=False,objects=False,instructions=False,st
             print('')
         
         if objects:
-            ztext = zmachine.get_ztext()
             print('Object Table Defaults\n--------\n')
             for i,val in enumerate(zmachine.story.object_table.property_defaults):
                 print('%d) %04x' % (i,val))
 
-            obj_count = zmachine.story.object_table.estimate_number_of_objects()
-            print('Object Tables (%d estimated)\n--------\n' % obj_count)
+            obj_count = zmachine.story.object_table.number_of_objects()
+            print('Object Tables (%d)\n--------\n' % obj_count)
             for i in range(1,obj_count+1):
                 obj = zmachine.story.object_table[i]
                 zc = obj['short_name_zc']
                 try:
-                    obj['short_name'],offset = ztext.to_ascii(zc,0,len(zc))
+                    zchars,offset = region.zchars_at(obj['property_address']+1,len(zc))
+                    obj['short_name'] = ztext.zchars_to_ascii(zchars)
                 except ZTextException:
                     obj['short_name'] = '(ZTEXT ERROR)'
                 print('%d) %s' % (i,obj))
@@ -112,6 +115,18 @@ def dump(path,abbrevs=False,dictionary=False,objects=False,instructions=False,st
             dump_memory(data,zmachine,header.abbrev_address,)
 
 
+        if strings or find:
+            print('')
+            string_index = zmachine.get_string_index()
+            if find:
+                print('Strings containing "%s"\n--------------\n' % find)
+                results = string_index.search(find)
+            else:
+                print('Strings (%d)\n--------------\n' % len(string_index))
+                results = string_index.search('')
+            for address,kind,text in results:
+                print('%04x %-12s %s' % (address,kind,repr(text)))
+
         if dictionary:
             print ('')
             print ('Dictionary\n--------------\n')
@@ -122,8 +137,8 @@ def dump(path,abbrevs=False,dictionary=False,objects=False,instructions=False,st
             print ('Keyboard codes:\n %s' % '\n '.join([ztext._map_zscii(x) for x in dictionary.keyboard_codes]))
             for i in range(0,len(dictionary)):
                 try:
-                    ztext.reset()
-                    text,offset = ztext.to_ascii(Memory(dictionary[i]), 0,4)
+                    zchars,offset = region.zchars_at(dictionary._get_item_address(i),4)
+                    text = ztext.zchars_to_ascii(zchars)
                 except ZTextException as e:  
                     print('Error. %s' % e)
                 print(' %d: %.2X %.2X %.2X %.2X (%s)' % (i, 
@@ -147,6 +162,8 @@ def main():
     parser.add_argument('--abbrevs',action='store_true')
     parser.add_argument('--objects',action='store_true')
     parser.add_argument('--instructions',action='store_true')    
+    parser.add_argument('--strings',action='store_true')
+    parser.add_argument('--find')
     parser.add_argument('--address')
     parser.add_argument('--file')
     data = parser.parse_args()
@@ -164,7 +181,8 @@ def main():
         start_address = int(addr_tmp,0)
     except ValueError:
         print('address must starat with 0x and be a valid hex address')
-    dump(filename, abbrevs=abbrevs,dictionary=dictionary,start_address=start_address,objects=objects,instructions=instructions)
+    dump(filename, abbrevs=abbrevs,dictionary=dictionary,start_address=start_address,objects=objects,instructions=instructions,
+         strings=data.strings,find=data.find)
 
 if __name__ == "__main__":
     main()
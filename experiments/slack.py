@@ -30,8 +30,9 @@ from slackclient import SlackClient
 
 from zmachine.interpreter import Story,Interpreter,OutputStream,OutputStreams,Memory,QuitException,\
                                  StoryFileException,InterpreterException,MemoryAccessException,\
-                                 InputStreams,InputStream,RestartException
+                                 InputStreams,InputStream
 from zmachine.text import ZTextException
+from zmachine.chunkstore import FileChunkStore
 from zmachine.memory import BitArray,MemoryException
 from zmachine.instructions import InstructionException
 
@@ -39,14 +40,14 @@ from zmachine.instructions import InstructionException
 # and the feed will be overwhelemed.
 RTM_FEED_POLL_SLEEP_IN_S=0.5
 
-def load_zmachine(filename,restart_flags=None):
+def load_zmachine(filename):
     """ Initialize a zmachine interpreter from tne story file and return it"""
     with open(filename,'rb') as f:
         story = Story(f.read())
         outputs = OutputStreams(OutputStream(),OutputStream())
         inputs = InputStreams(InputStream(),InputStream())
         zmachine = Interpreter(story,outputs,inputs,None,None)
-        zmachine.reset(restart_flags=restart_flags)
+        zmachine.reset()
         zmachine.story.header.set_debug_mode()
 
     return zmachine
@@ -187,6 +188,11 @@ class SlackOutputStream(object):
         self.slack_connection.api_call('chat.postMessage',channel=self.channel_id,text=status)
 
 class SaveRestoreMixin(object):
+    CHUNKS_DIRECTORY = 'chunks' # Directory under the save path holding the memory pages of every save
+
+    def chunk_store(self):
+        return FileChunkStore(os.path.join(self.save_path,SaveRestoreMixin.CHUNKS_DIRECTORY))
+
     def fix_filename(self, filename,user_id):
         """ Take a provided filename, strip any unwanted characters, then prefix with our story file name """
         return u'%s_%s_%s.sav' % (user_id,self.terp.story_filename,
@@ -210,8 +216,8 @@ class TerpSaveHandler(SaveRestoreMixin):
         try:
             if self.success_action:
                 self.success_action.apply(interpreter)
-            with open(os.path.join(self.save_path,filename),'w') as f:
-                f.write(json.dumps(interpreter.to_save_data()))
+            with open(os.path.join(self.save_path,filename),'wb') as f:
+                f.write(interpreter.to_chunked_save_data(self.chunk_store()))
             message = '\nSaved to %s' % original_filename
         except Exception as e:
             message = '\nError saving. %s' % (e,)
@@ -244,8 +250,8 @@ class TerpRestoreHandler(SaveRestoreMixin):
         filename = self.fix_filename(filename,self.player_id)
 
         try:
-            with open(os.path.join(self.save_path,filename),'r') as f:
-                interpreter.restore_from_save_data(f.read())
+            with open(os.path.join(self.save_path,filename),'rb') as f:
+                interpreter.restore_from_save_data(f.read(),chunk_store=self.chunk_store())
             message = '\nRestored from %s' % original_filename
         except Exception as e:
             message = '\nError restoring. %s' % (e,)
@@ -355,7 +361,7 @@ def main():
 
         try:
             MainLoop().run(sc, data.player_id, data.channel_id, zmachine,story_filename,data.save_path,quickrestore)
-        except (QuitException,RestartException):
+        except QuitException:
             quickrestore=False
 
 
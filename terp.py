@@ -11,7 +11,7 @@ from enum import Enum
 
 from zmachine.interpreter import Story,Interpreter,OutputStream,OutputStreams,Memory,QuitException,\
                                  StoryFileException,InterpreterException,MemoryAccessException,\
-                                 InputStreams,InputStream,RestartException
+                                 InputStreams,InputStream
 from zmachine.text import ZTextException
 from zmachine.memory import BitArray,MemoryException
 from zmachine.instructions import InstructionException
@@ -184,7 +184,7 @@ class MainLoop(object):
                 if not input_stream.waiting_for_line:
                     if terp.state == RunState.RUNNING:
                         terp.idle(input_stream)                
-            except (QuitException,RestartException) as e:
+            except QuitException as e:
                 self.zmachine.output_streams.flush()
                 raise e
             except FileStreamEmptyException:
@@ -195,23 +195,23 @@ class MainLoop(object):
         # If pygame returns False, treat as a quit
         raise QuitException()
 
-def load_zmachine(filename,restart_flags=None):
+def load_zmachine(filename):
     with open(filename,'rb') as f:
         story = Story(f.read())
         outputs = OutputStreams(OutputStream(),OutputStream())
         inputs = InputStreams(InputStream(),InputStream())
         zmachine = Interpreter(story,outputs,inputs,None,None)
-        zmachine.reset(restart_flags=restart_flags)
+        zmachine.reset()
         zmachine.story.header.set_debug_mode()
 
     return zmachine
 
-def start(path,commands_path,trace_file_path=None,seed=None,restart_flags=None,transcript_path=None,save_path=None):
+def start(path,commands_path,trace_file_path=None,seed=None,transcript_path=None,save_path=None):
     tracer = None
     if trace_file_path:
         tracer = Tracer()
 
-    zmachine = load_zmachine(path,restart_flags)
+    zmachine = load_zmachine(path)
     story_path, story_filename = os.path.split(path)        
     loop = MainLoop(zmachine,
         story_filename=story_filename,
@@ -238,18 +238,13 @@ def main(*args):
     data = parser.parse_args()
 
     try:
-        restart_flags = None # Per spec, when restarting, preserve bit 0 and bit 1 of flag 2 in header 
-        while True:
-            try:
-                start(data.story,
-                    commands_path=data.commands_path,
-                    trace_file_path=data.trace_file,
-                    seed=data.seed,
-                    transcript_path=data.transcript_path,
-                    save_path=data.save_path,
-                    restart_flags=restart_flags)    
-            except RestartException as e:
-                restart_flags = e.restart_flags
+        # Restarts are handled by the interpreter in place, so the story only needs to be started once
+        start(data.story,
+            commands_path=data.commands_path,
+            trace_file_path=data.trace_file,
+            seed=data.seed,
+            transcript_path=data.transcript_path,
+            save_path=data.save_path)
     except QuitException:
 
         print("Thanks for playing!")
@@ -3,20 +3,29 @@ import unittest
 import os
 import inspect
 import json
+import tempfile
 
 from zmachine.interpreter import Interpreter,StoryFileException,MemoryAccessException,\
                                  OutputStream,OutputStreams,SaveHandler,RestoreHandler,Story,\
                                 InterpreterException,QuitException,RestartException,Header,\
-                                InvalidSaveDataException,InputStream,InputStreams
-from zmachine.text import ZText,ZTextState,ZTextException
+                                InvalidSaveDataException,InputStream,InputStreams,ObjectTree
+from zmachine.text import ZText,ZTextState,ZTextException,ZCharRegion,encrypt_word
+import zmachine.text as text
+import zmachine.interpreter as interpreter
 from zmachine.memory import Memory
-from zmachine.dictionary import Dictionary
+from zmachine.dictionary import Dictionary,ParseCache,get_parse_cache
+from zmachine.undo import UndoBuffer
+from zmachine.chunkstore import ChunkStore,FileChunkStore
+from zmachine.savedata import compress_memory,decompress_memory,decode_save,is_binary_save,is_delta_save,\
+                              is_chunked_save,\
+                              save_dynamic_memory,SaveDataException
 from zmachine.instructions import InstructionForm,InstructionType,OperandType,OPCODE_HANDLERS,\
                                   read_instruction,extract_opcode,create_instruction,\
                                   process_operands, extract_literal_string, extract_branch_offset,\
                                   format_description,convert_to_unsigned,\
                                   JumpRelativeAction,CallAction,NextInstructionAction,OperandTypeHint,QuitAction,ReturnAction,\
-                                  InstructionException,RestoreAction,RestartAction,SaveAction
+                                  InstructionException,RestoreAction,RestartAction,SaveAction,walk_code
+from zmachine.strings import StringIndex
 import zmachine.instructions as instructions
 
 class TestOutputStream(OutputStream):
@@ -34,6 +43,7 @@ class TestOutputStream(OutputStream):
 
     def show_status(self, msg, score_mode=True,hours=0,minutes=0, score=0,turns=0):
         self.status_shown=True
+        self.status = (msg,score,turns)
 
 class TestSaveHandler(SaveHandler):
     pass
@@ -348,6 +358,48 @@ class ObjectTableTests(TestStoryMixin,unittest.TestCase):
         self.assertEqual(3, table.get_sibling(5))
         self.assertEqual(0, table.get_sibling(3))
 
+    def test_tree_mirror(self):
+        table = self.story.object_table
+        other_story = Story(self.story.story_data)
+        other_story.reset()
+        other_table = other_story.object_table
+        tree = other_table.enable_tree_mirror()
+        count = table.estimate_number_of_objects()
+        self.assertEqual([1],tree.children(11))
+        self.assertEqual([11],tree.ancestors(1))
+        moves = [(7,11),(3,2),(4,2),(5,2),(4,6),(5,0),(2,11),(3,7),(2,0),(11,0),(3,2),(7,2),(5,2),(7,0),(4,11)]
+        for obj_id,parent_id in moves:
+            for t in (table,other_table):
+                if parent_id:
+                    t.insert_obj(obj_id,parent_id)
+                else:
+                    t.remove_obj(obj_id)
+            for i in range(1,count+1):
+                self.assertEqual((table.get_parent(i),table.get_sibling(i),table.get_child(i)),
+                                 (other_table.get_parent(i),other_table.get_sibling(i),other_table.get_child(i)))
+                self.assertEqual((tree.parent[i],tree.sibling[i],tree.child[i]),
+                                 (other_table.get_parent(i),other_table.get_sibling(i),other_table.get_child(i)))
+            # The mirror should match one built from scratch
+            self.assertEqual(ObjectTree(other_table,count).prev_sibling,tree.prev_sibling)
+        self.assertEqual([5,3],tree.children(2))
+        self.assertEqual([2],tree.ancestors(3))
+
+        # Reorder the children of 2 by writing the tree bytes directly, as storeb would, leaving the mirror stale
+        for t in (table,other_table):
+            t._raw_data[t._child_addresses[2]] = 3
+            t._raw_data[t._sibling_addresses[3]] = 5
+            t._raw_data[t._sibling_addresses[5]] = 0
+            t.remove_obj(3)
+        for i in range(1,count+1):
+            self.assertEqual((table.get_parent(i),table.get_sibling(i),table.get_child(i)),
+                             (other_table.get_parent(i),other_table.get_sibling(i),other_table.get_child(i)))
+        self.assertEqual(5,other_table.get_child(2))
+        self.assertEqual(0,other_table.get_sibling(5))
+        self.assertEqual(0,other_table.get_parent(3))
+        tree = other_table.tree
+        self.assertEqual([5],tree.children(2))
+        self.assertEqual(ObjectTree(other_table,count).prev_sibling,tree.prev_sibling)
+
     def test_remove_obj(self):
         table = self.story.object_table
         self.assertEqual(11,table[1]['parent'])
@@ -396,6 +448,78 @@ class ObjectTableTests(TestStoryMixin,unittest.TestCase):
         self.assertEqual(19, table.get_next_prop(2,0))
         self.assertEqual(18, table.get_next_prop(2,19))
         self.assertEqual(0, table.get_next_prop(2,18))
+        with self.assertRaises(InterpreterException):
+            table.get_next_prop(2,3)
+        # No properties
+        self.assertEqual(0, table.get_next_prop(1,0))
+
+    def test_attribute_queries(self):
+        table = self.story.object_table
+        count = table.estimate_number_of_objects()
+        table.set_attribute(3,0,True)
+        table.set_attribute(3,31,True)
+        table.set_attribute(4,12,False)
+        expected = [[table.test_attribute(obj_id,a) for a in range(0,32)] for obj_id in range(1,count+1)]
+        self.assertTrue(expected[2][0] and expected[2][31])
+        self.assertFalse(expected[3][12])
+        old_numpy = interpreter.numpy
+        try:
+            for numpy in (old_numpy,None):
+                interpreter.numpy = numpy
+                self.assertEqual(expected,[list(row) for row in table.attribute_matrix()])
+        finally:
+            interpreter.numpy = old_numpy
+        for a in range(0,32):
+            self.assertEqual([obj_id for obj_id in range(1,count+1) if expected[obj_id-1][a]],table.objects_with_attribute(a))
+
+    def test_number_of_objects(self):
+        table = self.story.object_table
+        self.assertEqual(11, table.number_of_objects())
+        self.assertEqual(table.estimate_number_of_objects(), table.number_of_objects())
+
+    def test_snapshot(self):
+        table = self.story.object_table
+        snapshot = table.snapshot(self.zmachine.get_ztext())
+        self.assertEqual(11, snapshot.number_of_objects)
+        for obj_id in range(1,12):
+            obj = table[obj_id]
+            self.assertEqual((obj['parent'],obj['sibling'],obj['child'],obj['property_address']),
+                             (snapshot.parent[obj_id],snapshot.sibling[obj_id],snapshot.child[obj_id],snapshot.property_addresses[obj_id]))
+            self.assertEqual(str(obj['attributes']),'{0:032b}'.format(snapshot.attributes[obj_id]))
+        self.assertEqual('The first room',snapshot.short_names[1])
+        self.assertEqual([1],snapshot.children(11))
+        self.assertEqual([],snapshot.refresh())
+
+        # Only objects on changed pages are reloaded
+        table.insert_obj(7,2)
+        table.set_attribute(10,3,True)
+        self.assertEqual([1,2,3,4,5,6,7,8,9,10,11],snapshot.refresh())
+        self.assertEqual([7],snapshot.children(2))
+        self.assertTrue(snapshot.test_attribute(10,3))
+        table.set_attribute(11,0,True)
+        changed = snapshot.refresh()
+        self.assertTrue(11 in changed and 1 not in changed)
+        self.assertTrue(snapshot.test_attribute(11,0))
+
+    def test_tree_accessors(self):
+        table = self.story.object_table
+        for obj_id in range(1,table.estimate_number_of_objects()+1):
+            obj = table[obj_id]
+            self.assertEqual(obj['parent'], table.get_parent(obj_id))
+            self.assertEqual(obj['sibling'], table.get_sibling(obj_id))
+            self.assertEqual(obj['child'], table.get_child(obj_id))
+            self.assertTrue(table.is_child_of(obj_id,obj['parent']))
+            self.assertTrue(table.is_sibling_of(obj['sibling'],obj_id))
+        self.assertEqual(table.objects_start_address+9, table._obj_start_addr(2))
+
+    def test_get_property_index(self):
+        table = self.story.object_table
+        index = table.get_property_index(2)
+        self.assertTrue(index is table.get_property_index(2))
+        self.assertEqual({19: (503,4), 18: (508,2)}, index['properties'])
+        self.assertEqual([19,18], index['property_ids_ordered'])
+        self.assertEqual((508,2), table.get_property_info(2,18))
+        self.assertEqual(None, table.get_property_info(2,3))
 
     def test_get_property_address(self):
         table = self.zmachine.story.object_table
@@ -464,21 +588,50 @@ class InterpreterStepTests(TestStoryMixin,unittest.TestCase):
         self.assertRaises(QuitException, QuitAction(self.zmachine.pc).apply,self.zmachine)
 
     def test_restart(self):
-        self.zmachine.story.header.set_flag(Header.FLAGS_2,0,1)
-        self.zmachine.story.header.set_flag(Header.FLAGS_2,1,1)
-        try:
-            RestartAction().apply(self.zmachine)
-            self.fail('Should have thrown restart error')
-        except RestartException as e:
-            self.assertEqual((True,True),e.restart_flags)
+        memory = self.zmachine.story.raw_data
+        original = bytes(memory._raw_data)
+        memory.set_flag(Header.FLAGS_2,0,1)
+        memory.set_flag(Header.FLAGS_2,1,1)
+        memory.set_flag(Header.FLAGS_2,2,1)
+        memory[0x40] = (memory[0x40] + 1) % 256
+        self.zmachine.current_routine().push_to_stack(1)
+        self.zmachine.pc += 1
+        self.zmachine.state = Interpreter.WAITING_FOR_LINE_STATE
+        object_table = self.zmachine.story.object_table
 
+        RestartAction().apply(self.zmachine)
+        self.assertEqual(original[0x40],memory[0x40])
+        self.assertTrue(memory.flag(Header.FLAGS_2,0))
+        self.assertTrue(memory.flag(Header.FLAGS_2,1))
+        self.assertFalse(memory.flag(Header.FLAGS_2,2))
+        self.assertEqual(1,len(self.zmachine.routines))
+        self.assertEqual([],self.zmachine.current_routine().stack)
+        self.assertEqual(self.zmachine.current_routine().code_starts_at,self.zmachine.pc)
+        self.assertEqual(Interpreter.RUNNING_STATE,self.zmachine.state)
+        self.assertTrue(object_table is self.zmachine.story.object_table)
+
+        memory.set_flag(Header.FLAGS_2,0,0)
+        RestartAction().apply(self.zmachine)
+        self.assertFalse(memory.flag(Header.FLAGS_2,0))
+        self.assertTrue(memory.flag(Header.FLAGS_2,1))
+
+        # The streams are kept as selected, as is the transcript bit. A command file keeps playing from where it was
+        output_streams = self.zmachine.output_streams
+        transcript = output_streams[OutputStreams.TRANSCRIPT]
+        transcript.is_active = True
+        self.zmachine.input_streams = InputStreams(InputStream(),InputStream())
+        self.zmachine.input_streams.select_stream(InputStreams.FILE)
+        RestartAction().apply(self.zmachine)
+        self.assertTrue(output_streams is self.zmachine.output_streams)
+        self.assertTrue(self.screen is output_streams[OutputStreams.SCREEN])
+        self.assertTrue(self.screen.is_active)
+        self.assertTrue(transcript.is_active)
+        self.assertTrue(self.zmachine.input_streams.active_stream is self.zmachine.input_streams.command_file_stream)
+
+        # RestartException still carries the flags to preserve, for hosts that restart by reloading the story
         self.zmachine.story.header.set_flag(Header.FLAGS_2,0,0)
         self.zmachine.story.header.set_flag(Header.FLAGS_2,1,1)
-        try:
-            RestartAction().apply(self.zmachine)
-            self.fail('Should have thrown restart error')
-        except RestartException as e:
-            self.assertEqual((False,True), e.restart_flags)
+        self.assertEqual((False,True),RestartException(self.zmachine.story).restart_flags)
 
 
 class ObjectInstructionsTests(TestStoryMixin,unittest.TestCase):
@@ -1485,6 +1638,23 @@ class MiscInstructionsTests(TestStoryMixin,unittest.TestCase):
         self.assertEqual('zeroOP:show_status',description)
         self.assertTrue(self.zmachine.output_streams[0].status_shown)
 
+    def test_show_status_cache(self):
+        routine = self.zmachine.current_routine()
+        routine.set_nth_global(0,1)
+        routine.set_nth_global(1,10)
+        routine.set_nth_global(2,3)
+        self.zmachine.show_status()
+        self.assertEqual(('The first room',10,3),self.zmachine.output_streams[0].status)
+        key = list(self.zmachine._status_names.keys())[0]
+        self.assertEqual(1,key[0])
+        self.zmachine._status_names[key] = 'Cached room'
+        routine.set_nth_global(2,4)
+        self.zmachine.show_status()
+        self.assertEqual(('Cached room',10,4),self.zmachine.output_streams[0].status)
+        routine.set_nth_global(0,0)
+        self.zmachine.show_status()
+        self.assertEqual(('INVALID OBJECT',10,4),self.zmachine.output_streams[0].status)
+
     def test_verify(self):
         memory = create_instruction(InstructionType.zeroOP,0x0D,[],branch_to=0x02)
         handler_f, description, next_address = read_instruction(memory,0,3,self.zmachine.get_ztext())
@@ -1885,6 +2055,10 @@ class ZTextTests(unittest.TestCase):
         # 6 uses next to chars for lookup if in A2
         ztext = ZText(version=3,get_abbrev_f=lambda x: b'\x11\xaa\x46\x34\x16\x45\x9c\xa5')
         self.assertEqual(' Hello.\nHello.\nbHello.\nbBb\nbaA[b', ''.join(ztext._handle_zchars([0,1,1,2,7,7,3,7,7,4,7,7,5,7,7,6,4,6,5,6,2,27,7])))
+        # Each abbreviation is only decoded once
+        self.assertEqual({1:'Hello.\n',39:'Hello.\n',71:'Hello.\n'},ztext._abbreviations)
+        ztext._abbreviations[1] = 'Cached'
+        self.assertEqual(' Cached',''.join(ztext._handle_zchars([0,1,1])))
 
     def test_zchars(self):
         ztext = ZText(version=1,get_abbrev_f=self.get_abbrev_f)
@@ -1954,6 +2128,27 @@ class ZTextTests(unittest.TestCase):
         s,offset = ztext.to_ascii(data,0,2)
         self.assertEqual('   ',s)
     
+    def test_zchar_region(self):
+        ztext = ZText(version=3,get_abbrev_f=self.get_abbrev_f)
+        # 'Hello.' at 1, a one word string at 9 and a short name length string at 12 
+        memory = Memory([0xff,0x11,0xaa,0x46,0x34,0x16,0x45,0x9c,0xa5,0x94,0xa5,0xff,0x16,0x45,0x14,0xa5])
+        old_numpy = text.numpy
+        try:
+            for numpy in (old_numpy,None):
+                text.numpy = numpy
+                region = ZCharRegion(memory)
+                zchars,next_address = region.zchars_at(1)
+                self.assertEqual(9,next_address)
+                self.assertEqual('Hello.\n',ztext.zchars_to_ascii(zchars))
+                zchars,next_address = region.zchars_at(9)
+                self.assertEqual([5,5,5],zchars)
+                self.assertEqual(11,next_address)
+                zchars,next_address = region.zchars_at(12,4)
+                self.assertEqual(16,next_address)
+                self.assertEqual(ztext.to_ascii(memory,12,4)[0],ztext.zchars_to_ascii(zchars))
+        finally:
+            text.numpy = old_numpy
+
     def test_to_ascii_shift(self):
         ztext = ZText(version=3,get_abbrev_f=self.get_abbrev_f)
         self.assertEqual('.',ztext.to_ascii(Memory([0x16,0x45,0x94,0xA5]),0,4)[0])
@@ -2015,6 +2210,20 @@ class ZTextTests(unittest.TestCase):
         # This was throwing an exception due to the shifts. NOte that the shifts for v3 
         # means much of the buffer ends up thrown away
         self.assertEqual(bytearray([21,37,172,189]),ztext.encrypt('13:43')) 
+        # Unmappable characters are dropped, and case is ignored
+        self.assertEqual(ztext.encrypt('about'),ztext.encrypt('AB{o}UT'))
+        self.assertEqual(bytearray([0x14,0xA5,0x94,0xA5]),ztext.encrypt(None))
+
+    def test_encrypt_word(self):
+        encrypt_word.cache_clear()
+        self.assertEqual(b'\x18\xf4\xeb\x25',encrypt_word(3,'about'))
+        self.assertEqual(b'\x18\xf4\xeb\x25',encrypt_word(3,'about'))
+        self.assertEqual(1,encrypt_word.cache_info().hits)
+        # encrypt hands out a copy, so callers can't change the memoized value
+        ztext = ZText(version=3,get_abbrev_f=self.get_abbrev_f)
+        key = ztext.encrypt('about')
+        key[0] = 0
+        self.assertEqual(bytearray([0x18,0xF4,0xEB,0x25]),ztext.encrypt('about'))
 
     def test_encrypt_text_v1(self):
         # See 3.7.1 and 3.5.4
@@ -2153,6 +2362,187 @@ class SampleFileTests(unittest.TestCase):
         data['checksum'] = old_checksum
         self.zmachine.restore_from_save_data(json.dumps(data))
 
+    def test_binary_save_and_restore(self):
+        count = 0
+        while self.zmachine.state == Interpreter.RUNNING_STATE and count < 100:
+            self.zmachine.step()
+            count += 1
+        self.zmachine.current_routine().stack.extend([-1,0x12345])
+        old_memory = bytes(self.zmachine.story.raw_data._raw_data)
+        old_routines = [x.to_dict() for x in self.zmachine.routines]
+        old_pc = self.zmachine.pc
+
+        data = self.zmachine.to_binary_save_data()
+        self.assertTrue(is_binary_save(data))
+        self.assertTrue(len(data) < 500)
+        self.assertEqual(decode_save(data,self.story.story_data)['dynamic_memory'],
+                         bytearray(self.zmachine.to_save_data()['dynamic_memory']))
+
+        story = Story(self.story.story_data)
+        zmachine = Interpreter(story,TestOutputStreams(),None,TestSaveHandler(),TestRestoreHandler())
+        zmachine.reset()
+        zmachine.restore_from_save_data(data)
+        self.assertEqual(old_memory,bytes(zmachine.story.raw_data._raw_data))
+        self.assertEqual(old_routines,[x.to_dict() for x in zmachine.routines])
+        self.assertEqual(old_pc,zmachine.pc)
+        self.assertEqual(self.zmachine._text_buffer_addr,zmachine._text_buffer_addr)
+
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data[0:-3])
+        data = bytearray(data)
+        data[5] ^= 0xFF # Part of the checksum
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data)
+
+    def test_delta_save_and_restore(self):
+        base_memory = self.zmachine.dynamic_memory()
+        base_data = self.zmachine.to_binary_save_data()
+        count = 0
+        while self.zmachine.state == Interpreter.RUNNING_STATE and count < 100:
+            self.zmachine.step()
+            count += 1
+        data = self.zmachine.to_delta_save_data(base_memory)
+        self.assertTrue(is_delta_save(data))
+        self.assertFalse(is_delta_save(base_data))
+        memory = save_dynamic_memory(data,self.story.story_data,save_dynamic_memory(base_data,self.story.story_data))
+        self.assertEqual(self.zmachine.dynamic_memory(),bytes(memory))
+
+        story = Story(self.story.story_data)
+        zmachine = Interpreter(story,TestOutputStreams(),None,TestSaveHandler(),TestRestoreHandler())
+        zmachine.reset()
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data)
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data,base_memory=memory)
+        zmachine.restore_from_save_data(data,base_memory=base_memory)
+        self.assertEqual(self.zmachine.dynamic_memory(),zmachine.dynamic_memory())
+        self.assertEqual(self.zmachine.pc,zmachine.pc)
+
+    def test_undo(self):
+        def current_state():
+            return (self.zmachine.dynamic_memory(),self.zmachine.pc,
+                    json.dumps([x.to_dict() for x in self.zmachine.routines]))
+
+        self.assertFalse(self.zmachine.undo())
+        states = []
+        for i in range(0,3):
+            self.zmachine.take_snapshot()
+            states.append(current_state())
+            for j in range(0,10):
+                self.zmachine.step()
+        self.zmachine.current_routine().stack.append(7)
+        self.assertEqual(3,self.zmachine.undo_depth())
+        self.assertFalse(self.zmachine.undo(4))
+
+        self.assertTrue(self.zmachine.undo())
+        self.assertEqual(states[2],current_state())
+        for j in range(0,10):
+            self.zmachine.step()
+        self.assertTrue(self.zmachine.undo(2))
+        self.assertEqual(states[0],current_state())
+        self.assertEqual(0,self.zmachine.undo_depth())
+
+        # Oldest snapshots are dropped once the buffer is full
+        memory = bytearray(1000)
+        undo = UndoBuffer(memory,len(memory),max_snapshots=2)
+        for i in range(0,3):
+            memory[i*300] = i+1
+            undo.push(i)
+        self.assertEqual(2,len(undo))
+        memory[999] = 9
+        self.assertEqual(1,undo.pop(2))
+        self.assertEqual(b'\x01\x02\x00',bytes(memory[0:601:300]))
+        self.assertEqual(0,memory[999])
+
+        # Memory past the end of dynamic memory is never touched, even when the last page is partial
+        memory = bytearray(range(0,256)) * 4
+        undo = UndoBuffer(memory,300)
+        undo.push(None)
+        memory[299] = 0xFF
+        undo.pop()
+        self.assertEqual(1024,len(memory))
+        self.assertEqual(bytes(range(0,256)) * 4,bytes(memory))
+
+    def test_fork(self):
+        self.zmachine.story.rng.enter_predictable_mode(5)
+        for i in range(0,10):
+            self.zmachine.step()
+        fork = self.zmachine.fork()
+        self.assertEqual(self.zmachine.dynamic_memory(),fork.dynamic_memory())
+        self.assertEqual([x.to_dict() for x in self.zmachine.routines],[x.to_dict() for x in fork.routines])
+        self.assertTrue(fork.story.dictionary is self.story.dictionary)
+        self.assertTrue(fork._instruction_cache is self.zmachine._instruction_cache)
+        self.assertFalse(fork.get_ztext() is self.zmachine.get_ztext())
+        self.assertTrue(fork.get_ztext()._abbreviations is self.zmachine.get_ztext()._abbreviations)
+        self.assertEqual(self.zmachine.story.rng.randint(1000),fork.story.rng.randint(1000))
+
+        fork.story.raw_data[0x40] = (fork.story.raw_data[0x40] + 1) % 256
+        fork.current_routine().push_to_stack(7)
+        self.assertNotEqual(self.zmachine.dynamic_memory(),fork.dynamic_memory())
+        self.assertNotEqual(self.zmachine.current_routine().stack,fork.current_routine().stack)
+
+        fork.current_routine().pop_from_stack()
+        for i in range(0,10):
+            self.zmachine.step()
+            fork.step()
+        self.assertEqual(self.zmachine.pc,fork.pc)
+
+    def test_restore_keeps_story(self):
+        data = self.zmachine.to_save_data()
+        for i in range(0,10):
+            self.zmachine.step()
+        self.zmachine.story.raw_data[0x40] = (self.zmachine.story.raw_data[0x40] + 1) % 256
+        object_table = self.story.object_table
+        instruction_cache = self.zmachine._instruction_cache
+        self.zmachine.story.rng.enter_predictable_mode(3)
+
+        # Memory past the end of the saved memory comes from the original story
+        data['dynamic_memory'] = data['dynamic_memory'][0:0x30]
+        self.zmachine.restore_from_save_data(json.dumps(data))
+        self.assertEqual(bytes(self.story.story_data[0:self.story.header.static_memory_address]),
+                         self.zmachine.dynamic_memory())
+        self.assertTrue(object_table is self.story.object_table)
+        self.assertTrue(instruction_cache is self.zmachine._instruction_cache)
+        self.assertEqual(3,self.story.rng.seed)
+
+        data['dynamic_memory'] = [0] * (self.story.header.static_memory_address+1)
+        self.assertRaises(InvalidSaveDataException,self.zmachine.restore_from_save_data,json.dumps(data))
+
+    def test_chunked_save_and_restore(self):
+        chunk_store = ChunkStore()
+        base_data = self.zmachine.to_chunked_save_data(chunk_store)
+        page_count = len(chunk_store)
+        for i in range(0,10):
+            self.zmachine.step()
+        data = self.zmachine.to_chunked_save_data(chunk_store)
+        self.assertTrue(is_chunked_save(data))
+        self.assertTrue(is_binary_save(data))
+        # Only the pages that changed are added
+        self.assertTrue(len(chunk_store) < page_count * 2)
+
+        story = Story(self.story.story_data)
+        zmachine = Interpreter(story,TestOutputStreams(),None,TestSaveHandler(),TestRestoreHandler())
+        zmachine.reset()
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data)
+        self.assertRaises(InvalidSaveDataException, zmachine.restore_from_save_data,data,chunk_store=ChunkStore())
+        zmachine.restore_from_save_data(data,chunk_store=chunk_store)
+        self.assertEqual(self.zmachine.dynamic_memory(),zmachine.dynamic_memory())
+        self.assertEqual(self.zmachine.pc,zmachine.pc)
+
+        with tempfile.TemporaryDirectory() as path:
+            file_store = FileChunkStore(os.path.join(path,'chunks'))
+            data = self.zmachine.to_chunked_save_data(file_store)
+            self.assertTrue(len(file_store) > 0)
+            zmachine.restore_from_save_data(base_data,chunk_store=chunk_store)
+            zmachine.restore_from_save_data(data,chunk_store=file_store)
+            self.assertEqual(self.zmachine.dynamic_memory(),zmachine.dynamic_memory())
+
+    def test_compress_memory(self):
+        original = bytes(range(0,256)) * 4
+        memory = bytearray(original)
+        self.assertEqual(b'',compress_memory(memory,original))
+        memory[0] = 0xFF
+        memory[600] = 0
+        self.assertEqual(b'\xff\x00\xff\x00\xff\x00\x56\x58',compress_memory(memory,original))
+        self.assertEqual(memory,decompress_memory(compress_memory(memory,original),original))
+        self.assertRaises(SaveDataException,decompress_memory,b'\x01\x00',original)
+
     def test_save_and_restore(self):
         # Run until command prompt to set up some memory.
         count = 0
@@ -2202,14 +2592,80 @@ class SampleFileTests(unittest.TestCase):
         self.assertEqual(2220, dictionary.lookup([ztext.to_zscii('d')],ztext))
         self.assertEqual(2290, dictionary.lookup([ztext.to_zscii(c) for c in 'examin'],ztext))
 
+    def test_dictionary_lookup_key(self):
+        dictionary = self.zmachine.story.dictionary
+        unindexed = Dictionary(self.story.raw_data,self.story.header.dictionary_address,None,use_index=False)
+        for idx in range(0,len(dictionary)):
+            address = dictionary._get_item_address(idx)
+            self.assertEqual(address, dictionary.lookup_key(dictionary[idx]))
+            self.assertEqual(address, unindexed.lookup_key(dictionary[idx]))
+        missing = self.zmachine.get_ztext().encrypt('xyzzy')
+        self.assertEqual(None, dictionary.lookup_key(missing))
+        self.assertEqual(None, unindexed.lookup_key(missing))
+
+    def test_tokenize(self):
+        ztext = self.zmachine.get_ztext()
+        dictionary = self.zmachine.story.dictionary
+        line = [ztext.to_zscii(c) for c in 'd xyzzy,examin']
+        self.assertEqual([(2220,1,0),(0,5,2),(2115,1,7),(2290,6,8)], dictionary.tokenize(line,ztext))
+        self.assertEqual([(2220,1,0),(0,5,2)], dictionary.tokenize(line,ztext,2))
+        self.assertEqual([dictionary.tokenize(line,ztext),[]], dictionary.tokenize_many(['d xyzzy,examin',''],ztext))
+
+    def test_handle_input(self):
+        class LineStream(object):
+            def readline(self):
+                return 'D xyzzy,examin'
+        self.zmachine.input_streams = InputStreams(LineStream(),None)
+        self.zmachine.input_streams.reset()
+        raw_data = self.story.game_memory._raw_data
+        text_buffer_addr = self.story.header.static_memory_address - 64
+        parse_buffer_addr = text_buffer_addr + 32
+        raw_data[text_buffer_addr] = 11 # Room for 10 letters
+        raw_data[parse_buffer_addr] = 3 # Room for 3 words
+        self.zmachine._text_buffer_addr = text_buffer_addr
+        self.zmachine._parse_buffer_addr = parse_buffer_addr
+        self.assertTrue(self.zmachine._handle_input())
+        self.assertEqual(b'd xyzzy,ex\x00', bytes(raw_data[text_buffer_addr+1:text_buffer_addr+12]))
+        self.assertEqual(bytes([3, 0x08,0xac,1,1, 0,0,5,3, 0x08,0x43,1,8]),
+                         bytes(raw_data[parse_buffer_addr+1:parse_buffer_addr+14]))
+
+        # Interpreters on the same story share parsed lines
+        parse_cache = self.zmachine._parse_cache
+        self.assertTrue((b'd xyzzy,ex',3) in parse_cache._entries)
+        zmachine = Interpreter(Story(bytes(self.story.story_data)),TestOutputStreams(),None,TestSaveHandler(),TestRestoreHandler())
+        zmachine.reset()
+        self.assertTrue(parse_cache is zmachine._parse_cache)
+        self.assertFalse(parse_cache is get_parse_cache((self.story.story_hash,2)))
+
+    def test_parse_cache(self):
+        cache = ParseCache(max_size=2)
+        cache.put('a',1)
+        cache.put('b',2)
+        self.assertEqual(1,cache.get('a'))
+        cache.put('c',3)
+        self.assertEqual(None,cache.get('b'))
+        self.assertEqual(1,cache.get('a'))
+        self.assertEqual(3,cache.get('c'))
+        self.assertEqual((3,1),(cache.hits,cache.misses))
+        self.assertEqual(2,len(cache))
+
     def test_randomizer(self):
         # This really isn't a "unit" test. It's more of a smoke test,
         # just to see if the RNG is totally failing
         rng = self.zmachine.story.rng
+        draws = rng.draws
         for i in range(0,100):
             x = rng.randint(i+1)
             self.assertTrue(x >= 1)
             self.assertTrue(x <= i+1)
+        self.assertEqual(draws+100,rng.draws)
+
+        # Reseeding changes the usage, even with the same seed
+        rng.enter_predictable_mode(0)
+        usage = rng.usage()
+        rng.enter_predictable_mode(0)
+        self.assertNotEqual(usage,rng.usage())
+        self.assertEqual(rng.usage(),rng.clone().usage())
 
         # In predictable mode, should return same value
         rng.enter_predictable_mode(0)
@@ -2244,6 +2700,15 @@ class SampleFileTests(unittest.TestCase):
     def test_checksum(self):
         self.assertEqual(0xf3a4,self.zmachine.story.calculate_checksum())
 
+    def test_story_image(self):
+        image = self.zmachine.story.image
+        self.assertEqual(0xf3a4,image.calculated_checksum)
+        self.assertEqual(2,image.packed_address_multiplier)
+        self.zmachine.reset()
+        self.assertTrue(image is self.zmachine.story.image)
+        self.assertEqual(0x0835,self.zmachine.story.header.static_memory_address)
+        self.assertEqual(2,self.zmachine.story.header.packed_address_multiplier)
+
     def test_dictionary(self):
         dictionary = self.zmachine.story.dictionary
         self.assertEqual([0x2e,0x2c,0x22], dictionary.keyboard_codes)
@@ -2289,6 +2754,49 @@ class SampleFileTests(unittest.TestCase):
         # Verify stored in right place in memory
         self.assertEqual(0x0012,self.zmachine.story.game_memory.word(self.zmachine.story.header.global_variables_address+(17-0x10)*2))
 
+class StringIndexTests(TestStoryMixin,unittest.TestCase):
+    def test_walk_code(self):
+        header = self.story.header
+        instructions,routines = walk_code(self.story.raw_data,header.main_routine_addr,header.version)
+        self.assertTrue(header.main_routine_addr in instructions)
+        self.assertTrue(len(routines) > 0)
+        # The first instruction of every routine found should have been decoded
+        for routine_address in routines:
+            self.assertTrue(routine_address + 1 + (self.story.raw_data[routine_address]*2) in instructions)
+
+    def test_index(self):
+        index = self.zmachine.get_string_index()
+        self.assertEqual(index, self.zmachine.get_string_index())
+        self.assertEqual([0x1e8], index.addresses_for('The first room'))
+        self.assertEqual((StringIndex.OBJECT_NAME,'The first room'), index.entries[0x1e8])
+        self.assertEqual('Welcome!', index.text_at(0xcd8))
+        self.assertEqual(StringIndex.LITERAL, index.entries[0xcd8][0])
+        self.assertEqual(None, index.text_at(0xcd9))
+        self.assertEqual([], index.addresses_for('Not in the story'))
+
+    def test_search(self):
+        index = self.zmachine.get_string_index()
+        self.assertEqual([(0x2189,StringIndex.LITERAL,'It is pitch black. You are likely to be eaten by a grue.')],
+                         index.search('GRUE'))
+        self.assertEqual([], index.search('GRUE',ignore_case=False))
+        self.assertEqual(2,len(index.search('unsure what')))
+
+    def test_decode_string(self):
+        ztext = self.zmachine.get_ztext()
+        self.assertTrue(ztext is self.zmachine.get_ztext())
+        static_address = self.story.header.static_memory_address
+        self.assertTrue(0x2189 >= static_address)
+        text = 'It is pitch black. You are likely to be eaten by a grue.'
+        self.assertEqual(text,self.zmachine.decode_string(0x2189))
+        self.assertEqual(text,self.zmachine._string_cache[0x2189])
+        # Strings in dynamic memory are not cached
+        self.assertEqual('The first room',self.zmachine.decode_string(0x1e8))
+        self.assertFalse(0x1e8 in self.zmachine._string_cache)
+        self.zmachine.prewarm_string_cache()
+        self.assertEqual('Welcome!',self.zmachine._string_cache[0xcd8])
+        self.zmachine.reset()
+        self.assertEqual({},self.zmachine._string_cache)
+        self.assertFalse(ztext is self.zmachine.get_ztext())
 
 if __name__ == '__main__':
     unittest.main()
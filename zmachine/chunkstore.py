@@ -0,0 +1,69 @@
+""" Content-addressed stores for the pages of chunked saves (see zmachine.savedata.encode_chunked_save).
+
+    A page is stored under the SHA-1 digest of its contents, so a page shared by many saves (an unchanged part
+    of memory, or many players at the same point in a story) is only stored once.
+"""
+import hashlib
+import os
+
+from zmachine.savedata import SaveDataException
+
+def chunk_digest(chunk):
+    """ Return the 20 byte digest a chunk is stored under """
+    return hashlib.sha1(chunk).digest()
+
+class ChunkStore(object):
+    """ In-memory chunk store. Subclasses store chunks elsewhere by overriding put_many and get_many """
+    def __init__(self):
+        self._chunks = {} # digest -> chunk
+
+    def put_many(self,chunks):
+        """ Store chunks (a list of bytes), returning the digest of each """
+        digests = [chunk_digest(chunk) for chunk in chunks]
+        for digest,chunk in zip(digests,chunks):
+            self._chunks.setdefault(digest,chunk)
+        return digests
+
+    def get_many(self,digests):
+        """ Return the chunk stored under each digest. Raises SaveDataException if any are missing """
+        try:
+            return [self._chunks[digest] for digest in digests]
+        except KeyError:
+            raise SaveDataException('Save data refers to a missing page.')
+
+    def __len__(self):
+        return len(self._chunks)
+
+class FileChunkStore(ChunkStore):
+    """ Chunk store keeping each chunk in its own file in a directory, named by its digest """
+    def __init__(self,path):
+        self.path = path
+
+    def _chunk_path(self,digest):
+        return os.path.join(self.path,digest.hex())
+
+    def put_many(self,chunks):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        digests = [chunk_digest(chunk) for chunk in chunks]
+        for digest,chunk in zip(digests,chunks):
+            chunk_path = self._chunk_path(digest)
+            if not os.path.exists(chunk_path):
+                with open(chunk_path,'wb') as f:
+                    f.write(chunk)
+        return digests
+
+    def get_many(self,digests):
+        chunks = []
+        for digest in digests:
+            try:
+                with open(self._chunk_path(digest),'rb') as f:
+                    chunks.append(f.read())
+            except IOError:
+                raise SaveDataException('Save data refers to a missing page.')
+        return chunks
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return len(os.listdir(self.path))
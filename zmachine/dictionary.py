@@ -2,15 +2,23 @@
     See http://inform-fiction.org/zmachine/standards/z1point0/sect13.html
 """
 
-from zmachine.text import ZText
+import threading
+from collections import OrderedDict
+
+from zmachine.text import ZText,encrypt_word
 
 class Dictionary(object):
-    def __init__(self,data,start_address,logger):
+    KEY_LENGTH = 4 # Bytes of encoded text per entry in versions 1-3. See 13.3
+
+    def __init__(self,data,start_address,logger,use_index=True):
         self._memory = data
         self._start_address = start_address
         self._addr = start_address
         self._load_header()
         self.logger = logger
+        self._index = None
+        if use_index:
+            self._build_index()
 
     def _increment_addr(self,amount=1):
         self._addr+=amount
@@ -23,44 +31,67 @@ class Dictionary(object):
         for i in range(0,num_codes):
             self.keyboard_codes.append(self._memory[self._addr])
             self._increment_addr()
+        self._separators = frozenset(self.keyboard_codes)
         self.entry_length = self._memory[self._addr]
         self._increment_addr()
         self.number_of_entries = self._memory.word(self._addr)
         self._increment_addr(2)
 
+    def _build_index(self):
+        # Map each encoded key to the address of the first entry with that key
+        self._index = {}
+        for idx in range(0,self.number_of_entries):
+            address = self._get_item_address(idx)
+            self._index.setdefault(bytes(self._memory[address:address+Dictionary.KEY_LENGTH]),address)
+
     def lookup(self,word,ztext):
         """ Take a word (as a list of ZSCII) and look it up in the dictionary. Return byte address if present,
             None otherwise. ztext is a ZText reference. """
         # Convert our zscii to a string
         word_str = ''.join([ztext.zscii_to_ascii(c) for c in word])
-        zchar_word = ztext.encrypt(word_str)
-        for idx in range(0,len(self)):
-            if self[idx] == zchar_word:
-                return self._get_item_address(idx)
+        return self.lookup_key(encrypt_word(ztext.version,word_str))
 
+    def lookup_key(self,key):
+        """ Return the byte address of the entry for the encoded key (as from ZText.encrypt), or None.
+            Uses the index if one was built, otherwise a binary search """
+        key = bytes(key)
+        if self._index is not None:
+            return self._index.get(key)
+        return self._binary_search(key)
+
+    def _binary_search(self,key):
+        # 13.4 -- entries are stored in numerical order of their encoded text
+        low,high = 0,self.number_of_entries
+        while low < high:
+            mid = (low+high) // 2
+            address = self._get_item_address(mid)
+            entry_key = bytes(self._memory[address:address+Dictionary.KEY_LENGTH])
+            if entry_key < key:
+                low = mid+1
+            else:
+                high = mid
+        if low < self.number_of_entries:
+            address = self._get_item_address(low)
+            if bytes(self._memory[address:address+Dictionary.KEY_LENGTH]) == key:
+                return address
         return None
 
     def split(self,chars):
         """ Split the text into a list of words and indexes of their location in the string per 13.5.1. 
             Text is array of ZSCII """
+        separators = self._separators
         words = []
         word = []
-        index=0
         word_start=0
-        for c in chars:
-            index+=1
-            if c == ZText.SPACE:
+        for index,c in enumerate(chars):
+            if c == ZText.SPACE or c in separators:
                 if word:
                     words.append((word_start,word))
                     word = []
-                word_start=index
-            elif c in self.keyboard_codes:
-                if word:
-                    words.append((word_start,word))
-                    word = []
-                    word_start=index-1
-                words.append((word_start,[c]))
-                word_start=index
+                if c != ZText.SPACE:
+                    # Separators are words in their own right
+                    words.append((index,[c]))
+                word_start=index+1
             else:
                 word.append(c)
         if word:
@@ -68,6 +99,24 @@ class Dictionary(object):
 
         return words
 
+    def tokenize(self,chars,ztext,max_words=None):
+        """ Split the text (array of ZSCII) into words and look each one up. Return a list of 
+            (dictionary address or 0,word length,index of word in the text), at most max_words long """
+        words = self.split(chars)
+        if max_words is not None:
+            words = words[0:max_words]
+        return [(self.lookup(word,ztext) or 0,len(word),offset) for offset,word in words]
+
+    def tokenize_many(self,lines,ztext,max_words=None):
+        """ Tokenize each of lines, for replaying or testing a large number of commands. Lines can be
+            arrays of ZSCII or strings """
+        results = []
+        for line in lines:
+            if isinstance(line,str):
+                line = [ztext.to_zscii(c) for c in line]
+            results.append(self.tokenize(line,ztext,max_words))
+        return results
+
     def _get_item_address(self, item_idx):
         if item_idx < 0 or item_idx >= self.number_of_entries:
             raise IndexError('%d out of range for dictionary.' % (item_idx))
@@ -82,3 +131,52 @@ class Dictionary(object):
         address = self._get_item_address(item_idx)
         return bytearray(self._memory[address:address+4])        
 
+
+class ParseCache(object):
+    """ LRU cache from an input line to the images of the text buffer and parse buffer it produces. 
+        Tokenizing only depends on the dictionary, so one cache can be shared by every interpreter 
+        running the same story (see get_parse_cache) """
+    DEFAULT_SIZE = 1000
+
+    def __init__(self,max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        """ Return the value for key, or None """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses+=1
+            else:
+                self.hits+=1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self,key,value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_parse_caches = {}
+_parse_caches_lock = threading.Lock()
+
+def get_parse_cache(story_key):
+    """ Return the parse cache shared by all interpreters for the story identified by story_key """
+    with _parse_caches_lock:
+        cache = _parse_caches.get(story_key)
+        if cache is None:
+            cache = _parse_caches[story_key] = ParseCache()
+        return cache
@@ -88,13 +88,34 @@ def operand_from_bitfield(bf):
 ### a handler function (taking an interpreter) and a description of this instruction
 def read_instruction(memory,address,version,ztext):
     """ Read the instruction at the given address, and return a handler function and summary """
+    instruction = decode_instruction(memory,address,version,ztext)
+    instruction_type = instruction['type']
+    handler = instruction['handler']
+    operands = instruction['operands']
+    next_address = instruction['next_address']
+    store_to = instruction['store_to']
+    branch_offset = instruction['branch_offset']
+    branch_if_true = instruction['branch_if_true']
+    literal_string = instruction['literal_string']
+
+    # Create the handler function for this instruction
+    handler_f = lambda interpreter: handler['handler'](interpreter, operands, next_address,store_to,branch_offset,branch_if_true, literal_string)
+
+    # Setup text version for debuggging
+    description = format_description(instruction_type, handler, operands, store_to, branch_offset, branch_if_true, literal_string)
+    
+    return handler_f,description,next_address
+
+def decode_instruction(memory,address,version,ztext):
+    """ Decode the instruction at the given address into a dict of its parts. If ztext is None any
+        literal string is skipped over rather than decoded (literal_address is still set) """
     # If top two bits are 11, variable form. If 10, short. 
     # If opcode is BE, form is extended. Otherwise long.
     start_address=address
 
     branch_offset = None # Offset, in bytes, to move PC
     store_to = None # Variable # to store the resulting value to
-    zchars = [] # If this instruction works with zcodes, store them here
+    literal_address = None # Address of the zchars of the literal string, if any
     literal_string = None # Ascii version of zchars, if any
 
     address,instruction_form, instruction_type,  opcode_number,operands = extract_opcode(memory,address)
@@ -107,7 +128,11 @@ def read_instruction(memory,address,version,ztext):
     address, operands = process_operands(operands, handler,memory,address,version)
 
     if handler.get('literal_string'):
-        address,literal_string = extract_literal_string(memory,address,ztext)
+        literal_address = address
+        if ztext:
+            address,literal_string = extract_literal_string(memory,address,ztext)
+        else:
+            address = skip_literal_string(memory,address)
         
     # 4.6
     if handler.get('store'):
@@ -118,15 +143,67 @@ def read_instruction(memory,address,version,ztext):
     branch_if_true=False
     if handler.get('branch'):
         address, branch_offset,branch_if_true = extract_branch_offset(memory,address)
-    next_address = address
 
-    # Create the handler function for this instruction
-    handler_f = lambda interpreter: handler['handler'](interpreter, operands, next_address,store_to,branch_offset,branch_if_true, literal_string)
-
-    # Setup text version for debuggging
-    description = format_description(instruction_type, handler, operands, store_to, branch_offset, branch_if_true, literal_string)
-    
-    return handler_f,description,next_address
+    return {'address': start_address,
+            'type': instruction_type,
+            'handler': handler,
+            'operands': operands,
+            'next_address': address,
+            'store_to': store_to,
+            'branch_offset': branch_offset,
+            'branch_if_true': branch_if_true,
+            'literal_address': literal_address,
+            'literal_string': literal_string}
+
+def walk_code(memory,start_address,version,ztext=None):
+    """ Statically walk all code reachable from start_address (the first instruction of the main routine),
+        following branches, jumps and calls to constant routine addresses. Calls through variables can't
+        be followed, so this finds most but not necessarily all of a story's code.
+
+        Returns a dict of address -> decoded instruction (see decode_instruction) for every instruction found, 
+        plus a sorted list of the routine addresses found """
+    instructions = {}
+    routines = set()
+    to_visit = [start_address]
+    while to_visit:
+        address = to_visit.pop()
+        while address not in instructions:
+            try:
+                instruction = decode_instruction(memory,address,version,ztext)
+            except Exception:
+                # Walked into data, or off the end of memory. Stop following this path.
+                break
+            instructions[address] = instruction
+            handler_f = instruction['handler']['handler']
+            next_address = instruction['next_address']
+            operands = instruction['operands']
+
+            # 4.7.2 -- branches of 0 and 1 are returns, not jumps
+            branch_offset = instruction['branch_offset']
+            if branch_offset not in (None,0,1):
+                to_visit.append(next_address + branch_offset - 2)
+
+            if handler_f == op_call and operands and operands[0][1] == OperandTypeHint.packed_address:
+                routine_address = operands[0][0]
+                if routine_address and routine_address < len(memory) and routine_address not in routines:
+                    # 5.2 -- skip over the local variable count and initial values to the first instruction
+                    var_count = memory[routine_address]
+                    if var_count <= 15:
+                        routines.add(routine_address)
+                        if version < 5:
+                            to_visit.append(routine_address + 1 + (var_count * 2))
+                        else:
+                            to_visit.append(routine_address + 1)
+            elif handler_f == op_jump:
+                if operands[0][1] == OperandTypeHint.signed:
+                    to_visit.append(next_address + operands[0][0] - 2)
+                break
+
+            if handler_f in NO_FALLTHROUGH_HANDLERS:
+                break
+            address = next_address
+
+    return instructions,sorted(routines)
 
 def extract_opcode(memory,address):
     """ Handle section 4.3 """
@@ -248,6 +325,12 @@ def extract_literal_string(memory,address,ztext):
     text, next_address = ztext.to_ascii(memory,zchar_start_address,0)   
     return next_address,text
 
+def skip_literal_string(memory,address):
+    """ Return the address just past the literal string starting at address, without decoding it """
+    while not memory[address] & 0x80:
+        address+=2
+    return address+2
+
 def extract_branch_offset(memory,address):
     """ Handle section 4.7 """
     b = memory[address]
@@ -515,14 +598,12 @@ def op_print(interpreter,operands,next_address,store_to,branch_offset,branch_if_
 
 def op_print_paddr(interpreter,operands,next_address,store_to,branch_offset,branch_if_true,literal_string):
     addr = dereference_variables(operands[0],interpreter)
-    text,offset = interpreter.get_ztext().to_ascii(interpreter.story.game_memory._raw_data, addr)
-    interpreter.output_streams.print_str(text)
+    interpreter.output_streams.print_str(interpreter.decode_string(addr))
     return NextInstructionAction(next_address)
 
 def op_print_addr(interpreter,operands,next_address,store_to,branch_offset,branch_if_true,literal_string):
     addr = dereference_variables(operands[0],interpreter)
-    text,offset = interpreter.get_ztext().to_ascii(interpreter.story.game_memory._raw_data, addr)
-    interpreter.output_streams.print_str(text)
+    interpreter.output_streams.print_str(interpreter.decode_string(addr))
     return NextInstructionAction(next_address)
 
 def op_print_num(interpreter,operands,next_address,store_to,branch_offset,branch_if_true,literal_string):
@@ -832,21 +913,21 @@ def op_jin(interpreter,operands,next_address,store_to,branch_offset,branch_if_tr
 def op_get_prop(interpreter,operands,next_address,store_to,branch_offset,branch_if_true,literal_string,debug=False):
     object_number = dereference_variables(operands[0],interpreter)
     property_number = dereference_variables(operands[1],interpreter)
-    obj = interpreter.story.object_table[object_number]
-    if not obj:
+    object_table = interpreter.story.object_table
+    if object_number == 0 or object_number > 255:
         raise InstructionException('get_prop called with non-existant object id %d' % object_number)
     value = 0
-    try:
-        prop = obj['properties'][property_number]['data']
-        mem = Memory(prop)
-        if len(mem) > 2:
+    prop = object_table.get_property_info(object_number,property_number)
+    if prop:
+        address,size = prop
+        if size > 2:
             raise InstructionException('get_prop called with larger than 2byte property %d for object id %d' % (property_number,object_number))
-        elif len(mem) > 1:
-            value = mem.word(0)
+        elif size > 1:
+            value = interpreter.story.game_memory.word(address)
         else:
-            value = mem[0]
-    except KeyError:
-        value = interpreter.story.object_table.get_default_property(property_number)
+            value = interpreter.story.game_memory[address]
+    else:
+        value = object_table.get_default_property(property_number)
 
     interpreter.current_routine()[store_to]= value
 
@@ -1212,6 +1293,9 @@ def op_sound_effect(interpreter,operands,next_address,store_to,branch_offset,bra
     interpreter.play_sound(v1,v2,v3,v4)
     return NextInstructionAction(next_address)   
 
+# Handlers after which execution never continues to the next instruction
+NO_FALLTHROUGH_HANDLERS = (op_rtrue,op_rfalse,op_print_ret,op_ret,op_ret_popped,op_jump,op_quit,op_restart)
+
 ### 14.1
 OPCODE_HANDLERS = {
 (InstructionType.zeroOP,0):  {'name': 'rtrue', 'handler': op_rtrue},
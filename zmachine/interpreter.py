@@ -4,10 +4,22 @@
 import random
 import os
 import json
+import struct
+import hashlib
+import copy
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None # Bulk attribute queries fall back to lists
 
 from zmachine.memory import Memory,BitArray
 from zmachine.text import ZText
-from zmachine.dictionary import Dictionary
+from zmachine.dictionary import Dictionary,get_parse_cache
+from zmachine.strings import StringIndex
+from zmachine.undo import UndoBuffer
+from zmachine.savedata import encode_save,encode_delta_save,encode_chunked_save,decode_save,is_binary_save,\
+                              is_delta_save,is_chunked_save,SaveDataException
 from zmachine.instructions import read_instruction,JumpRelativeAction,NextInstructionAction
 
 # First global variable in the variable numbering system
@@ -45,8 +57,13 @@ class RestartException(Exception):
 
 class RNG(object):
     """ The random number generator, as specced in section 2.4
-        Note that it toggles between a predicatable and random mode """
+        Note that it toggles between a predicatable and random mode. Each RNG has its own generator,
+        so forked interpreters don't disturb each other's sequence """
     def __init__(self):
+        self._random = random.Random()
+        # Counts of random numbers returned and of reseeds, to tell whether a stretch of play used the RNG
+        self.draws = 0
+        self.reseeds = 0
         self.enter_random_mode()
         self.seed = 0
 
@@ -59,11 +76,28 @@ class RNG(object):
         self._reseed()
 
     def _reseed(self):
-        random.seed(self.seed)
+        self.reseeds += 1
+        self._random.seed(self.seed)
+
+    def usage(self):
+        """ Return a value that changes whenever the RNG is drawn from or reseeded. If it is the same before
+            and after some play, that play didn't depend on the RNG """
+        return (self.draws,self.reseeds)
 
     def randint(self,n):       
         """ Return random integer r such that 1 <= r <= n """
-        return random.randint(1,n)
+        self.draws += 1
+        return self._random.randint(1,n)
+
+    def clone(self):
+        """ Return a new RNG in the same mode and state, which will produce the same sequence as this one """
+        other = RNG.__new__(RNG)
+        other.seed = self.seed
+        other.draws = self.draws
+        other.reseeds = self.reseeds
+        other._random = random.Random()
+        other._random.setstate(self._random.getstate())
+        return other
 
 class Screen(object):
     """ Abstraction of a screen for display """
@@ -76,6 +110,30 @@ class Screen(object):
     def supports_screen_splitting(self):
         return False
 
+class StoryImage(object):
+    """ Values parsed once from the original story data: the header addresses and the checksum of the data.
+        None of these can change while the story runs, so a story parses them once and shares them across
+        resets, restores and restarts """
+    def __init__(self,data):
+        if len(data) < Header.HEADER_SIZE:
+            raise StoryFileException('Story file is too short')
+        header = Memory(data[0:Header.HEADER_SIZE])
+        self.version = header[Header.VERSION]
+        self.himem_address = header.word(Header.HIMEM)
+        self.main_routine_addr = header.word(Header.MAIN_ROUTINE)
+        self.dictionary_address = header.word(Header.DICTIONARY)
+        self.object_table_address = header.word(Header.OBJECT_TABLE)
+        self.global_variables_address = header.word(Header.GLOBAL_VARIABLES)
+        self.static_memory_address = header.word(Header.STATIC_MEMORY)
+        self.abbrev_address = header.word(Header.ABBREV_TABLE)
+        # This length is divided by a constant that varies based on version. V1-3 has a constant of 2
+        self.file_length = header.word(Header.FILE_LENGTH)*2
+        self.checksum = header.word(Header.CHECKSUM)
+        self.revision_number = header.word(Header.REVISION_NUMBER)
+        self.packed_address_multiplier = 4 if self.version > 3 else 2
+        # Unsigned sum, mod 65536, of all bytes past the header (see verify)
+        self.calculated_checksum = sum(bytes(data[Header.HEADER_SIZE:])) % 65536
+
 class Header(Memory):
     VERSION = 0x00
     FLAGS_1 = 0x01
@@ -100,58 +158,27 @@ class Header(Memory):
     """ Represents the header of a ZCode file, bytes 0x00 through 0x40. The usage of the data will vary
         based on the version of the file. Most of the memory is read-only for a game. Some of the remainder
         is set by the game, other by the interpreter itself. """
-    def __init__(self,data,force_version=0):
+    def __init__(self,data,force_version=0,image=None):
+        """ image is the StoryImage of the story this header belongs to. If not passed, one is parsed from data """
         self.force_version = force_version
         super(Header,self).__init__(data)
+        image = image or StoryImage(data)
+
+        # The game can't change these, so they are plain attributes (see StoryImage)
+        self.version = force_version or image.version
         if self.version > Header.MAX_VERSION:
             raise StoryFileException('Story file version %d is not supported.' % self.version)
-
-    @property
-    def version(self):
-        if self.force_version:
-            return self.force_version
-        return self[Header.VERSION]
-
-    @property
-    def himem_address(self):
-        return self.word(Header.HIMEM)
-
-    @property
-    def main_routine_addr(self): 
-        return self.word(Header.MAIN_ROUTINE)
-
-    @property
-    def dictionary_address(self):
-        return self.word(Header.DICTIONARY)
-
-    @property
-    def object_table_address(self):
-        return self.word(Header.OBJECT_TABLE)
-
-    @property
-    def global_variables_address(self):
-        return self.word(Header.GLOBAL_VARIABLES)
-
-    @property
-    def static_memory_address(self):
-        return self.word(Header.STATIC_MEMORY)
-
-    @property
-    def abbrev_address(self):
-        return self.word(Header.ABBREV_TABLE)
-
-    @property
-    def file_length(self):
-        # This length is divided by a constant that varies based on version. V1-3 has a constant of 2
-        return self.word(Header.FILE_LENGTH)*2
-
-    @property 
-    def checksum(self):
-        return self.word(Header.CHECKSUM)
-
-    @property
-    def revision_number(self):
-        return self.word(Header.REVISION_NUMBER)
+        self.himem_address = image.himem_address
+        self.main_routine_addr = image.main_routine_addr
+        self.dictionary_address = image.dictionary_address
+        self.object_table_address = image.object_table_address
+        self.global_variables_address = image.global_variables_address
+        self.static_memory_address = image.static_memory_address
+        self.abbrev_address = image.abbrev_address
+        self.file_length = image.file_length
+        self.checksum = image.checksum
+        self.revision_number = image.revision_number
+        self.packed_address_multiplier = 4 if self.version > 3 else 2
 
     @property
     def flag_status_line_type(self):
@@ -347,6 +374,130 @@ class Routine(object):
         except IndexError:
             raise InterpreterException('Cannot pop from empty stack')
 
+class ObjectTree(object):
+    """ In-memory mirror of the object tree (12.3) with previous-sibling links, so objects can be unlinked 
+        without walking their siblings and tools can query the tree without touching memory. It is kept in
+        sync by ObjectTableManager, so only changes made through the manager are seen. The manager checks
+        each previous-sibling link against memory before using it, and rebuilds the mirror if it is stale. """
+    def __init__(self,object_table,number_of_objects):
+        self.number_of_objects = number_of_objects
+        size = ObjectTableManager.MAX_OBJECTS+1
+        self.parent = [0] * size
+        self.sibling = [0] * size
+        self.child = [0] * size
+        self.prev_sibling = [0] * size
+        for obj_id in range(1,number_of_objects+1):
+            self.parent[obj_id] = object_table.get_parent(obj_id)
+            self.sibling[obj_id] = object_table.get_sibling(obj_id)
+            self.child[obj_id] = object_table.get_child(obj_id)
+        for obj_id in range(1,number_of_objects+1):
+            previous_id = 0
+            child_id = self.child[obj_id]
+            for i in range(0,number_of_objects):
+                if not child_id:
+                    break
+                self.prev_sibling[child_id] = previous_id
+                previous_id = child_id
+                child_id = self.sibling[child_id]
+
+    def children(self,obj_id):
+        """ Return the ids of the children of obj_id, in order """
+        children = []
+        child_id = self.child[obj_id]
+        while child_id and child_id not in children:
+            children.append(child_id)
+            child_id = self.sibling[child_id]
+        return children
+
+    def ancestors(self,obj_id):
+        """ Return the ids of the parent of obj_id, its parent, and so on up to the root """
+        ancestors = []
+        parent_id = self.parent[obj_id]
+        while parent_id and parent_id not in ancestors:
+            ancestors.append(parent_id)
+            parent_id = self.parent[parent_id]
+        return ancestors
+
+class ObjectTableSnapshot(object):
+    """ Compact copy of the object table, for tools and the status line. Arrays are indexed by object id
+        (0 is unused). Call refresh to bring it up to date.
+
+        Changes aren't tracked as memory is written. Each refresh copies all the object records and compares
+        them with the copy from the last refresh, 64 bytes at a time, and only reloads the objects on pages
+        that differ. This saves unpacking every object and decoding its short name, but the cost of the
+        compare grows with the size of the table. Short names are decoded again when an object's property
+        table address changes. """
+    PAGE_SIZE = 64
+
+    def __init__(self,object_table,ztext=None):
+        self.object_table = object_table
+        self.ztext = ztext
+        self.number_of_objects = object_table.number_of_objects()
+        size = self.number_of_objects+1
+        self.parent = array('B',[0]) * size
+        self.sibling = array('B',[0]) * size
+        self.child = array('B',[0]) * size
+        self.attributes = array('L',[0]) * size # Attribute 0 is the top bit (12.3.1)
+        self.property_addresses = array('H',[0]) * size
+        self.short_names = [None] * size
+
+        self._record_size = object_table._object_record_size()
+        self._start_address = object_table._object_addresses[1]
+        self._end_address = self._start_address + (self._record_size * self.number_of_objects)
+        self._records = bytearray()
+        self.refresh()
+
+    def refresh(self):
+        """ Update from memory, comparing the whole table with the last refresh. Return the ids of the objects
+            that were reloaded """
+        raw_data = self.object_table._raw_data
+        records = raw_data[self._start_address:self._end_address]
+        if not self._records:
+            changed = range(1,self.number_of_objects+1)
+        else:
+            changed = []
+            record_size = self._record_size
+            for offset in range(0,len(records),ObjectTableSnapshot.PAGE_SIZE):
+                end = offset+ObjectTableSnapshot.PAGE_SIZE
+                if records[offset:end] != self._records[offset:end]:
+                    # Reload every object with part of its record on this page
+                    first_id = (offset // record_size) + 1
+                    last_id = ((min(end,len(records))-1) // record_size) + 1
+                    if changed and changed[-1] >= first_id:
+                        first_id = changed[-1]+1
+                    changed.extend(range(first_id,last_id+1))
+        self._records = records
+        for obj_id in changed:
+            self._load_object(records,obj_id)
+        return list(changed)
+
+    def _load_object(self,records,obj_id):
+        offset = self._record_size * (obj_id-1)
+        self.attributes[obj_id] = (records[offset] << 24) | (records[offset+1] << 16) | (records[offset+2] << 8) | records[offset+3]
+        self.parent[obj_id] = records[offset+ObjectTableManager.PARENT_OFFSET]
+        self.sibling[obj_id] = records[offset+ObjectTableManager.SIBLING_OFFSET]
+        self.child[obj_id] = records[offset+ObjectTableManager.CHILD_OFFSET]
+        property_address = (records[offset+ObjectTableManager.PROPERTY_ADDRESS_OFFSET] << 8) | \
+                            records[offset+ObjectTableManager.PROPERTY_ADDRESS_OFFSET+1]
+        if property_address != self.property_addresses[obj_id] or self.short_names[obj_id] is None:
+            self.property_addresses[obj_id] = property_address
+            if self.ztext:
+                # 12.4 -- short name is a length byte (in words) followed by the ztext
+                raw_data = self.object_table._raw_data
+                self.short_names[obj_id] = self.ztext.to_ascii(raw_data,property_address+1,raw_data[property_address]*2)[0]
+
+    def test_attribute(self,obj_id,attribute_number):
+        return (self.attributes[obj_id] >> (31-attribute_number)) & 1 == 1
+
+    def children(self,obj_id):
+        """ Return the ids of the children of obj_id, in order """
+        children = []
+        child_id = self.child[obj_id]
+        while child_id and child_id not in children and child_id <= self.number_of_objects:
+            children.append(child_id)
+            child_id = self.sibling[child_id]
+        return children
+
 class ObjectTableManager(object):
     """ Handles the object table (see section 12.1). Note that requests to the table pass through, since we don't
         know for sure where the object table ends.
@@ -359,6 +510,11 @@ class ObjectTableManager(object):
     SIBLING_OFFSET=5
     CHILD_OFFSET=6
 
+    MAX_OBJECTS=255 # 12.3.1
+    ATTRIBUTE_COUNT=32 # 12.3.1
+    # Attribute number -> (byte offset in the object record,mask). Attribute 0 is the top bit of byte 0 (12.3.1)
+    ATTRIBUTE_MASKS=[(attribute_number >> 3,0x80 >> (attribute_number & 0x07)) for attribute_number in range(0,32)]
+
     def __init__(self,story):
         self.version = story.header.version
         self.game_memory = story.game_memory
@@ -368,6 +524,12 @@ class ObjectTableManager(object):
     def reset(self):
         self.objects_start_address = self.object_table_address
         self._load_defaults()
+        self._load_addresses()
+        self.tree = None # Optional mirror of the object tree, see enable_tree_mirror
+        self._number_of_objects = None
+        # obj id -> property index. Built as each object is used. The layout of property tables
+        # never changes at run time, only the data, so these stay valid until reset
+        self._property_indexes = {}
 
     def _load_defaults(self):
         """ Load the property defaults table. See 12.2 """
@@ -380,6 +542,17 @@ class ObjectTableManager(object):
             self.property_defaults.append(self.game_memory.word(self.objects_start_address))
             self.objects_start_address+=2
 
+    def _load_addresses(self):
+        """ Precompute the address of each object record, and of its tree bytes, so the tree
+            opcodes are a single index into memory """
+        self._raw_data = self.game_memory._raw_data
+        record_size = self._object_record_size() or 0
+        self._object_addresses = [self.objects_start_address + (record_size * (i-1)) 
+                                  for i in range(0,ObjectTableManager.MAX_OBJECTS+1)]
+        self._parent_addresses = [addr+ObjectTableManager.PARENT_OFFSET for addr in self._object_addresses]
+        self._sibling_addresses = [addr+ObjectTableManager.SIBLING_OFFSET for addr in self._object_addresses]
+        self._child_addresses = [addr+ObjectTableManager.CHILD_OFFSET for addr in self._object_addresses]
+
     def get_default_property(self,property_number):
         return self.property_defaults[property_number-1]
 
@@ -388,6 +561,32 @@ class ObjectTableManager(object):
             return 9
         return None
 
+    def number_of_objects(self):
+        """ Return the exact number of objects. There's no count in the story file, but the object records
+            are followed by the property tables (12.3, 12.4), so read records until reaching the lowest
+            property table address seen so far """
+        if self._number_of_objects is None:
+            record_size = self._object_record_size()
+            raw_data = self._raw_data
+            lowest_property_address = len(raw_data)
+            count = 0
+            while count < ObjectTableManager.MAX_OBJECTS:
+                address = self._object_addresses[count+1]
+                if address + record_size > lowest_property_address:
+                    break
+                property_address = (raw_data[address+ObjectTableManager.PROPERTY_ADDRESS_OFFSET] << 8) | \
+                                    raw_data[address+ObjectTableManager.PROPERTY_ADDRESS_OFFSET+1]
+                if property_address < address + record_size:
+                    break # Not a valid record, so we've gone past the end of the table
+                lowest_property_address = min(lowest_property_address,property_address)
+                count+=1
+            self._number_of_objects = count
+        return self._number_of_objects
+
+    def snapshot(self,ztext=None):
+        """ Return an ObjectTableSnapshot of the table. If ztext is passed, short names are decoded """
+        return ObjectTableSnapshot(self,ztext)
+
     def estimate_number_of_objects(self):
         """ Grab the first object and use its property table start as the assumed end of the
             object table, the work backwards. No gurantee to work! """
@@ -398,143 +597,171 @@ class ObjectTableManager(object):
             return 0 # Something's wrong, just return no objects
         return int(count)
 
-    def _find_attribute_start_byte(self,object_number,attribute_number):
-        """ Given a start address and an attribute number, return the byte address and relative
-            attribute number. For example, attribute 0 will return start_addr,0 while attribute 8 will
-            return start_addr+1,0 """
-        address = self._obj_start_addr(object_number)
-        if attribute_number > 31:
+    def _find_attribute_byte(self,object_number,attribute_number):
+        """ Given an object and attribute number, return the byte address and the mask for the attribute's bit """
+        if attribute_number > 31 or attribute_number < 0:
             raise StoryFileException('Request to test invalid attribute number %s on object %s' % (attribute_number,object_number))
-
-        while attribute_number > 7:
-            address+=1
-            attribute_number -= 8
-
-        return address,attribute_number
+        offset,mask = ObjectTableManager.ATTRIBUTE_MASKS[attribute_number]
+        return self._object_addresses[object_number]+offset,mask
 
     def test_attribute(self,object_number,attribute_number):
-        """ Return true if attribute # attr_number is set on object number object_number """
-        address,attribute_number = self._find_attribute_start_byte(object_number,attribute_number)
-        val = self.game_memory[address]
-        return (val >> (7-attribute_number)) & 0x01 == 1
+        """ Return true if attr_number is set on object number object_number """
+        address,mask = self._find_attribute_byte(object_number,attribute_number)
+        return self._raw_data[address] & mask != 0
  
     def set_attribute(self,object_number,attribute_number,new_val):
         """ Set # attr_number is set on object number object_number to new_val (True/False)"""
-        address,attribute_number = self._find_attribute_start_byte(object_number,attribute_number)
-        val = self.game_memory[address]
+        address,mask = self._find_attribute_byte(object_number,attribute_number)
         if new_val:
-            val = val |  (0x80 >> attribute_number)
+            self._raw_data[address] |= mask
         else:
-            val = val & ((0x80 >> attribute_number) ^ 0xff)
-        self.game_memory[address] = val
+            self._raw_data[address] &= mask ^ 0xff
+
+    def objects_with_attribute(self,attribute_number,number_of_objects=None):
+        """ Return the ids of every object with the attribute set, in one pass over the object table """
+        if number_of_objects is None:
+            number_of_objects = self.number_of_objects()
+        offset,mask = ObjectTableManager.ATTRIBUTE_MASKS[attribute_number]
+        raw_data = self._raw_data
+        addresses = self._object_addresses
+        return [obj_id for obj_id in range(1,number_of_objects+1) if raw_data[addresses[obj_id]+offset] & mask]
+
+    def attribute_matrix(self,number_of_objects=None):
+        """ Return every attribute of every object, where row n-1 has the 32 attributes of object n. This is
+            a NumPy bool array if NumPy is installed, otherwise a list of lists of bools """
+        if number_of_objects is None:
+            number_of_objects = self.number_of_objects()
+        record_size = self._object_record_size()
+        start = self._object_addresses[1]
+        data = bytes(self._raw_data[start:start+(record_size*number_of_objects)])
+        if numpy is not None:
+            records = numpy.frombuffer(data,dtype=numpy.uint8).reshape(number_of_objects,record_size)
+            return numpy.unpackbits(records[:,0:4],axis=1).astype(bool)
+        return [[data[(i*record_size)+offset] & mask != 0 for offset,mask in ObjectTableManager.ATTRIBUTE_MASKS]
+                for i in range(0,number_of_objects)]
 
     def is_sibling_of(self,sibling_obj_id,obj_id):
         """ Return True of obj is the sibling of obj """
-        obj = self[obj_id]
-        return obj['sibling'] == sibling_obj_id
+        return self._raw_data[self._sibling_addresses[obj_id]] == sibling_obj_id
 
     def is_child_of(self,child_obj_id,parent_obj_id):
         """ Return True if child_obj is child of parent_obj """
-        obj = self[child_obj_id]
-        return obj['parent'] == parent_obj_id
+        return self._raw_data[self._parent_addresses[child_obj_id]] == parent_obj_id
+
+    def enable_tree_mirror(self):
+        """ Keep an ObjectTree in sync with the object table, for constant time moves and tree queries """
+        self.tree = ObjectTree(self,self.number_of_objects())
+        return self.tree
+
+    def copy(self,story):
+        """ Return a manager for story, a fork of the story this one belongs to. The precomputed addresses and
+            property indexes are shared, since the layout of the tables is the same """
+        other = copy.copy(self)
+        other.game_memory = story.game_memory
+        other._raw_data = story.game_memory._raw_data
+        other._property_indexes = dict(self._property_indexes)
+        other.refresh_tree_mirror()
+        return other
+
+    def refresh_tree_mirror(self):
+        """ Rebuild the tree mirror, if there is one, after memory was changed outside the manager (such as 
+            a restore) """
+        if self.tree:
+            self.enable_tree_mirror()
+
+    def _set_parent(self,obj_id,parent_id):
+        self._raw_data[self._parent_addresses[obj_id]] = parent_id
+        if self.tree:
+            self.tree.parent[obj_id] = parent_id
+
+    def _set_sibling(self,obj_id,sibling_id):
+        self._raw_data[self._sibling_addresses[obj_id]] = sibling_id
+        if self.tree:
+            self.tree.sibling[obj_id] = sibling_id
+            if sibling_id:
+                self.tree.prev_sibling[sibling_id] = obj_id
+
+    def _set_child(self,obj_id,child_id):
+        self._raw_data[self._child_addresses[obj_id]] = child_id
+        if self.tree:
+            self.tree.child[obj_id] = child_id
+            if child_id:
+                self.tree.prev_sibling[child_id] = 0
+
+    def _previous_sibling(self,obj_id,parent_id):
+        """ Return the sibling before obj_id (0 if it is the first child), or None if obj_id isn't one of its 
+            parent's children """
+        if self.tree:
+            previous_id = self.tree.prev_sibling[obj_id]
+            if previous_id and self.get_sibling(previous_id) == obj_id:
+                return previous_id
+            if not previous_id and self.get_child(parent_id) == obj_id:
+                return previous_id
+            # The tree bytes were written directly (such as by storeb), so the mirror is stale. Resync it
+            # and walk memory instead
+            self.refresh_tree_mirror()
+        previous_id = 0
+        sibling_id = self.get_child(parent_id)
+        while sibling_id:
+            if sibling_id == obj_id:
+                return previous_id
+            previous_id = sibling_id
+            sibling_id = self.get_sibling(sibling_id)
+        return None
 
     def remove_obj(self,obj_id):
         """ Remove this objects from its parent (leaving its children) """
-        obj_start_addr = self._obj_start_addr(obj_id)
-
-        # need to identify this object's previous sibling, if any, and link to next sibling
-        obj = self[obj_id]
-        parent_obj = obj['parent']
-        if not parent_obj:
+        parent_id = self.get_parent(obj_id)
+        if not parent_id:
             return
-        parent_obj_start_addr = self._obj_start_addr(obj_id)
-        child_obj_id = self[parent_obj]['child']
-        if child_obj_id == obj_id:
-            self.game_memory[parent_obj_start_addr+ObjectTableManager.CHILD_OFFSET] = obj['sibling']
-        else:
-           previous_obj_id = None
-           while child_obj_id:
-            if child_obj_id == obj_id:
-                addr = self._obj_start_addr(previous_obj_id)
-                self.game_memory[addr+ObjectTableManager.SIBLING_OFFSET] = obj['sibling']
-                break
-            else:
-                previous_obj_id = child_obj_id
-                child_obj_id = self[child_obj_id]['sibling']
+
+        # Link this object's previous sibling (or its parent, if it is the first child) to its next sibling
+        sibling_id = self.get_sibling(obj_id)
+        previous_id = self._previous_sibling(obj_id,parent_id)
+        if previous_id:
+            self._set_sibling(previous_id,sibling_id)
+        elif previous_id == 0:
+            self._set_child(parent_id,sibling_id)
 
         # Now remove this obj from parent
-        self.game_memory[obj_start_addr+ObjectTableManager.PARENT_OFFSET] = 0
-        self.game_memory[obj_start_addr+ObjectTableManager.SIBLING_OFFSET] = 0
+        self._set_parent(obj_id,0)
+        self._set_sibling(obj_id,0)
+        if self.tree:
+            self.tree.prev_sibling[obj_id] = 0
 
     def insert_obj(self,obj_id,parent_id):
         """ Insert the obj obj_id at the front of parent_id """
         prev_child_id = self.get_child(parent_id)
         if prev_child_id == obj_id:
             return # We're already the child, do nothing
-   
-        # We need to find the previous object to the object we're moving under
-        # its old parent, since after we move our objects sibling is now the sibling
-        # of this object
-        old_parent_id = self.get_parent(obj_id)
-        old_child_id = self.get_child(old_parent_id)
-        old_sibling_id = self.get_sibling(obj_id)
-        if old_child_id == obj_id:
-            old_child_id = old_sibling_id
-            old_prev_sibling_id = 0
-        else:
-            old_prev_sibling_id = old_child_id
-            while old_prev_sibling_id and self.get_sibling(old_prev_sibling_id) != obj_id:
-                old_prev_sibling_id = self.get_sibling(old_prev_sibling_id)
-
-        # Set parent of object to new parent, and sibling to the previous child of
-        # the parent 
-        start_addr = self._obj_start_addr(obj_id)
-        self.game_memory[start_addr+ObjectTableManager.PARENT_OFFSET] = parent_id
-        self.game_memory[start_addr+ObjectTableManager.SIBLING_OFFSET] = prev_child_id
-
-        # Set child of new parent to object
-        start_addr = self._obj_start_addr(parent_id)
-        self.game_memory[start_addr+ObjectTableManager.CHILD_OFFSET] = obj_id
 
-        # Set child of old parent to old sibling of this object
-        start_addr = self._obj_start_addr(old_parent_id)
-        self.game_memory[start_addr+ObjectTableManager.CHILD_OFFSET] = old_child_id
+        self.remove_obj(obj_id)
 
-        # stitch up siblings of previous object, if we had one
-        if old_prev_sibling_id:
-            start_addr = self._obj_start_addr(old_prev_sibling_id)
-            self.game_memory[start_addr+ObjectTableManager.SIBLING_OFFSET] = old_sibling_id
+        # The object's sibling is the previous first child of its new parent
+        prev_child_id = self.get_child(parent_id)
+        self._set_sibling(obj_id,prev_child_id)
+        self._set_child(parent_id,obj_id)
+        self._set_parent(obj_id,parent_id)
 
     def get_next_prop(self,obj_id, property_id):
         """ Find the property after the identified property. If 0, first property. If property
             is last property, return 0. If no such property, error """
-        obj = self[obj_id]
-
-        if property_id == 0:
-            return obj['property_ids_ordered'][0]
-
-        if property_id and not obj['properties'].get(property_id):
+        next_property = self.get_property_index(obj_id)['next_property']
+        try:
+            return next_property[property_id]
+        except KeyError:
             raise InterpreterException('No property %d for object id %d' % (property_id, obj_id))
 
-        return_next = False
-        for i,tmp_id in enumerate(obj['property_ids_ordered']):
-            if return_next:
-                return tmp_id
-            if tmp_id == property_id:
-                return_next = True
-
-        return 0
-
     def get_property_address(self,obj_id, property_id):
         """ Return the address of the given property """
-        obj = self[obj_id]
-        start_addr = 0
-        try:
-            start_addr = obj['properties'][property_id]['address']
-        except KeyError:
-            start_addr = 0
+        prop = self.get_property_index(obj_id)['properties'].get(property_id)
+        if prop:
+            return prop[0]
+        return 0
 
-        return start_addr
+    def get_property_info(self,obj_id,property_id):
+        """ Return (address,size) of the given property, or None if the object doesn't have it """
+        return self.get_property_index(obj_id)['properties'].get(property_id)
 
     def get_property_length(self, prop_addr):
         """ Return the length of the property starting at the given address """
@@ -555,10 +782,10 @@ class ObjectTableManager(object):
 
     def put_prop(self,obj_id, property_id,value):
         """ Store a property in the property table """
-        prop_addr = self.get_property_address(obj_id, property_id)
-        if not prop_addr:
+        prop = self.get_property_info(obj_id, property_id)
+        if not prop:
             raise InterpreterException("Request to set non-existent property %s of obj %s to %s." % (obj_id, property_id, value))
-        prop_len = self.get_property_length(prop_addr)
+        prop_addr,prop_len = prop
         if prop_len > 2:
             raise InterpreterException("Request to set non-existent property %s of obj %s to %s for property greater than 2 bytes." % (obj_id, property_id, value))
         elif prop_len == 2:
@@ -567,45 +794,55 @@ class ObjectTableManager(object):
             self.game_memory[prop_addr] = value & 0xFF
 
     def get_child(self,obj_id):
-        start_addr = self._obj_start_addr(obj_id)
-        return self.game_memory[start_addr+ObjectTableManager.CHILD_OFFSET]
+        return self._raw_data[self._child_addresses[obj_id]]
 
     def get_parent(self,obj_id):
-        start_addr = self._obj_start_addr(obj_id)
-        return self.game_memory[start_addr+ObjectTableManager.PARENT_OFFSET]
+        return self._raw_data[self._parent_addresses[obj_id]]
 
     def get_sibling(self,obj_id):
-        start_addr = self._obj_start_addr(obj_id)
-        return self.game_memory[start_addr+ObjectTableManager.SIBLING_OFFSET]
-
-    def _get_properties(self, start_addr):
-        """ Return the properties at the given address """
+        return self._raw_data[self._sibling_addresses[obj_id]]
+
+    def get_property_index(self,obj_id):
+        """ Return the property index for the object: a dict with the address and length of its short name,
+            'properties' (property number -> (address,size)), 'property_ids_ordered' and 'next_property'
+            (property number -> number of the following property, where 0 maps to the first) """
+        index = self._property_indexes.get(obj_id)
+        if index is None:
+            # 12.3.1
+            start_addr = self._obj_start_addr(obj_id)
+            index = self._index_properties(self.game_memory.word(start_addr+ObjectTableManager.PROPERTY_ADDRESS_OFFSET))
+            self._property_indexes[obj_id] = index
+        return index
+
+    def _index_properties(self, start_addr):
+        """ Index the properties at the given address """
         properties = {}
         property_ids_ordered = []
 
         # 12.4
         text_length = self.game_memory[start_addr]
-        start_addr+=1
-        short_name_zc = self.game_memory._raw_data[start_addr:start_addr+(text_length*2)]
+        short_name_address = start_addr+1
 
-        start_addr+=text_length*2
-        size_byte_addr = start_addr
-        size_byte = self.game_memory[size_byte_addr]
+        start_addr+=1+(text_length*2)
+        size_byte = self.game_memory[start_addr]
         while size_byte:
-            start_addr+=1
-            property_number,property_size = self._extract_property_info(size_byte_addr)
-            data = self.game_memory._raw_data[start_addr:start_addr+property_size]
+            property_number,property_size = self._extract_property_info(start_addr)
             # NOte that the property address is the start of the property -- the size byte will be one previous
-            properties[property_number] = {'data': data, 'size': property_size, 'address': size_byte_addr+1}
+            properties[property_number] = (start_addr+1,property_size)
             property_ids_ordered.append(property_number)
-            start_addr+=property_size
+            start_addr+=1+property_size
             size_byte = self.game_memory[start_addr]
-            size_byte_addr = start_addr
 
-        return properties,property_ids_ordered,short_name_zc
+        next_property = dict(zip([0] + property_ids_ordered,property_ids_ordered + [0]))
+
+        return {'short_name_address': short_name_address,
+                'short_name_length': text_length*2,
+                'properties': properties,
+                'property_ids_ordered': property_ids_ordered,
+                'next_property': next_property}
 
     def _obj_start_addr(self, object_number):
-        return self.objects_start_address + (self._object_record_size() * (object_number-1))
+        return self._object_addresses[object_number]
 
     def is_valid_object_id(self,obj_id):
         if obj_id < 0 or obj_id > 255:
@@ -643,7 +880,13 @@ class ObjectTableManager(object):
         start_addr = self._obj_start_addr(key)  
 
         property_address = self.game_memory.word(start_addr+ObjectTableManager.PROPERTY_ADDRESS_OFFSET)
-        properties,property_ids_ordered,short_name_zc = self._get_properties(property_address)
+        index = self.get_property_index(key)
+        raw_data = self.game_memory._raw_data
+        short_name_address = index['short_name_address']
+        short_name_zc = raw_data[short_name_address:short_name_address+index['short_name_length']]
+        properties = {}
+        for property_number,(address,property_size) in index['properties'].items():
+            properties[property_number] = {'data': raw_data[address:address+property_size], 'size': property_size, 'address': address}
         obj = {'attributes': BitArray(self.game_memory._raw_data[start_addr:start_addr+4]),
               'parent': self.game_memory[start_addr+ObjectTableManager.PARENT_OFFSET], 
               'sibling': self.game_memory[start_addr+ObjectTableManager.SIBLING_OFFSET], 
@@ -651,7 +894,7 @@ class ObjectTableManager(object):
               'property_address': property_address,
               'short_name_zc': short_name_zc,
               'properties': properties,
-              'property_ids_ordered': property_ids_ordered
+              'property_ids_ordered': list(index['property_ids_ordered'])
               }
         return obj
 
@@ -833,6 +1076,8 @@ class Story(object):
 
         # Initial data, stored to allow for resets
         self.story_data = data
+        self._story_hash = None
+        self._image = None
 
         # Raw bytes of memory as a Memory object
         self.raw_data = None
@@ -841,16 +1086,18 @@ class Story(object):
         self.game_memory = None
         self.rng = RNG()
 
+        # Set to keep an in-memory mirror of the object tree (see ObjectTree)
+        self.mirror_object_tree = False
+
     def reset(self,force_version=0,logger=None,restart_flags=None):
         """ Reset/initialize the game state from the raw game data. Will raise StoryFileException on validation issues. 
             If force version is set, pretend this file is that version.
          """
         self.logger = logger or NullLogger()
+        image = self.image # Raises if the data is too short
         self.raw_data = Memory(self.story_data)
-        if len(self.story_data) < Story.MIN_FILE_SIZE:
-            raise StoryFileException('Story file is too short')
-        self._checksum = sum(self.raw_data[0x40:]) % 65536 # Store checksum at this point, since data will change post-load
-        self.header = Header(self.raw_data[0:Story.MIN_FILE_SIZE],force_version=force_version)
+        self._checksum = image.calculated_checksum
+        self.header = Header(self.raw_data[0:Story.MIN_FILE_SIZE],force_version=force_version,image=image)
         self.header.reset()
         self.dictionary = Dictionary(self.raw_data, self.header.dictionary_address,self.logger)
         self.game_memory = GameMemory(self.raw_data,
@@ -858,6 +1105,8 @@ class Story(object):
                                       self.header.himem_address)
 
         self.object_table = ObjectTableManager(self)
+        if self.mirror_object_tree:
+            self.object_table.enable_tree_mirror()
 
         # Default mode for RNG is random (see 2.4)
         self.rng.enter_random_mode()
@@ -868,6 +1117,40 @@ class Story(object):
             self.game_memory.set_flag(Header.FLAGS_2,1,restart_flags[1])
 
 
+    def reset_dynamic_memory(self,memory=b''):
+        """ Overwrite dynamic memory with memory, and anything past the end of it with the original story data,
+            without rebuilding the header, dictionary or object table """
+        static_address = self.header.static_memory_address
+        self.raw_data._raw_data[0:len(memory)] = memory
+        self.raw_data._raw_data[len(memory):static_address] = self.story_data[len(memory):static_address]
+
+    def fork(self):
+        """ Return a copy of this story with its own memory (copied from the current memory) and RNG. The 
+            original data, header and dictionary are shared, since the game can't change them """
+        story = Story.__new__(Story)
+        story.__dict__.update(self.__dict__)
+        story.raw_data = Memory(self.raw_data._raw_data)
+        story.game_memory = GameMemory(story.raw_data,
+                                       self.header.static_memory_address,
+                                       self.header.himem_address)
+        story.object_table = self.object_table.copy(story)
+        story.rng = self.rng.clone()
+        return story
+
+    @property
+    def image(self):
+        """ StoryImage of the original story data, parsed on first use """
+        if not self._image:
+            self._image = StoryImage(self.story_data)
+        return self._image
+
+    @property
+    def story_hash(self):
+        """ Hash of the original story data, identifying the story across Story instances """
+        if not self._story_hash:
+            self._story_hash = hashlib.sha1(bytes(self.story_data)).hexdigest()
+        return self._story_hash
+
     def calculate_checksum(self):
         """ Return the calculated checksum, which is the unsigned sum, mod 65536
             of all bytes past 0x0040. """
@@ -922,6 +1205,13 @@ class Interpreter(object):
 
         self._text_buffer_addr = None
         self._parse_buffer_addr = None
+        self._string_index = None
+        self._object_snapshot = None
+        self._status_names = {} # (room obj id,short name bytes) -> room name for the status line
+        self._ztext = ZText(version=self.story.header.version,get_abbrev_f=self.get_abbrev)
+        self._string_cache = {} # address -> text, for strings in static memory
+        self._parse_cache = get_parse_cache((self.story.story_hash,self.story.header.version))
+        self._undo = None # Snapshots are of the memory reset just replaced, so start over
 
         if not restoring:
             if self.output_streams:
@@ -930,6 +1220,48 @@ class Interpreter(object):
                 self.input_streams.reset()
             self.call_routine(self.pc,self.pc,None,None)
 
+    def fork(self,output_streams=None,input_streams=None):
+        """ Return an independent interpreter at the same point as this one, to branch off from. Memory, the 
+            call stack and the RNG are copied. The story data, instruction cache and text caches are shared,
+            since nothing the game does can change them. Each fork gets its own text decoder, so forks can run
+            on different threads. By default the new interpreter shares this one's streams and handlers; pass
+            output_streams/input_streams to give it its own. Undo snapshots are not copied """
+        self._check_initialized()
+        other = Interpreter(self.story.fork(),
+                            output_streams or self.output_streams,
+                            input_streams or self.input_streams,
+                            self.save_handler,
+                            self.restore_handler,
+                            self.screen)
+        other.initialized = True
+        other.pc = self.pc
+        other.state = self.state
+        other.last_instruction = self.last_instruction
+        other.routines = [self._copy_routine(other.story,r.to_dict()) for r in self.routines]
+        other._instruction_cache = self._instruction_cache
+        other._visited_addresses = {}
+        other._text_buffer_addr = self._text_buffer_addr
+        other._parse_buffer_addr = self._parse_buffer_addr
+        other._string_index = self._string_index
+        other._object_snapshot = None
+        other._status_names = self._status_names
+        other._ztext = self._ztext.fork(other.get_abbrev)
+        other._string_cache = self._string_cache
+        other._parse_cache = self._parse_cache
+        other._undo = None
+        if output_streams:
+            output_streams.reset(other,other.get_ztext())
+        if input_streams:
+            input_streams.reset()
+        return other
+
+    def _copy_routine(self,story,data):
+        """ Return a Routine on story's memory from a Routine.to_dict() result, copying the locals and stack """
+        return Routine(story.raw_data,
+                       story.header.global_variables_address,
+                       0,0,0,0,0,
+                       data=dict(data,local_variables=list(data['local_variables']),stack=list(data['stack'])))
+
     def call_routine(self, routine_address, next_address,  store_var,  local_vars):
         """ Add a routine call to the stack from the current program counter """
         new_routine = Routine(self.story.raw_data, 
@@ -954,11 +1286,45 @@ class Interpreter(object):
         self.pc = return_from_routine.return_to_address
     
     def get_ztext(self):
-        """ Return the a ztext processor for this interpreter """
+        """ Return the ztext processor for this interpreter. It is created on reset and shared by
+            everything that decodes or encodes text """
         self._check_initialized()
-        version = self.story.header.version
-        abbrev_address = self.story.header.abbrev_address
-        return ZText(version=version,get_abbrev_f=self.get_abbrev)
+        return self._ztext
+
+    def decode_string(self,address):
+        """ Return the text of the string at address. Strings in static memory can't change, 
+            so they are only decoded once """
+        self._check_initialized()
+        text = self._string_cache.get(address)
+        if text is None:
+            text,offset = self._ztext.to_ascii(self.story.raw_data,address)
+            if address >= self.story.header.static_memory_address:
+                self._string_cache[address] = text
+        return text
+
+    def prewarm_string_cache(self,string_index=None):
+        """ Fill the string cache from a string index (by default the one from get_string_index) """
+        string_index = string_index or self.get_string_index()
+        static_address = self.story.header.static_memory_address
+        for address,(kind,text) in string_index.entries.items():
+            if address >= static_address:
+                self._string_cache[address] = text
+
+    def get_object_snapshot(self):
+        """ Return a snapshot of the object table (with short names), refreshed from current memory """
+        self._check_initialized()
+        if not self._object_snapshot:
+            self._object_snapshot = self.story.object_table.snapshot(self.get_ztext())
+        else:
+            self._object_snapshot.refresh()
+        return self._object_snapshot
+
+    def get_string_index(self):
+        """ Return the static index of all strings in the story, building it on first use """
+        self._check_initialized()
+        if not self._string_index:
+            self._string_index = StringIndex(self.story,self.get_ztext())
+        return self._string_index
 
     def get_abbrev(self, index):
         # 3.3, 1.2.2 (word address = address / 2)
@@ -1035,9 +1401,7 @@ class Interpreter(object):
         return instructions
  
     def packed_address_to_address(self,address):
-        if self.story.header.version > 3:
-            return address * 4
-        return address * 2
+        return address * self.story.header.packed_address_multiplier
 
     def play_sound(self,number,effect,volume,routine):
         # No sound currently supported
@@ -1069,68 +1433,96 @@ class Interpreter(object):
         if len(line) > max_letters:
             line = line[0:max_letters]
 
-        # Write our ZSCII to the address, zero terminated
-        idx = text_buffer_addr+1
-        for zchar in line:
-            self.story.game_memory._raw_data[idx] = zchar
-            idx+=1
-        self.story.game_memory._raw_data[idx] = 0
-
         # Draw a newline
         self.output_streams.new_line() 
 
-        # Handle parse data
+        # Max words is in the first byte of the parse buffer
         max_words = self.story.game_memory[parse_buffer_addr]
-        idx = parse_buffer_addr+1
 
-        # Tokenize words using separators
-        dictionary = self.story.dictionary
-        words = dictionary.split(line)
-        # write number of words in byte 1
-        self.story.game_memory[idx] = len(words)
+        # The same line always produces the same buffers, so use the shared cache where we can
+        key = (bytes(line),max_words)
+        images = self._parse_cache.get(key)
+        if images is None:
+            # Our ZSCII, zero terminated
+            text_image = bytes(line) + b'\x00'
+            # Tokenize words using separators
+            tokens = self.story.dictionary.tokenize(line,ztext,max_words)
+            images = (text_image,self._pack_parse_buffer(tokens))
+            self._parse_cache.put(key,images)
+
+        text_image,parse_image = images
+        raw_data = self.story.game_memory._raw_data
+        raw_data[text_buffer_addr+1:text_buffer_addr+1+len(text_image)] = text_image
+        raw_data[parse_buffer_addr+1:parse_buffer_addr+1+len(parse_image)] = parse_image
 
-        # for each word up to max, write
+        return True
+
+    def _pack_parse_buffer(self,tokens):
+        # Byte 1 has the number of words, then for each word
         # (a) two bytes w/ addr of word (0 is missing)
         # (b) byte containing word length then 
         # (c) byte containing index of first letter of this word in the text buffer
-        # (d) empty byte
-        idx+=1
-        for offset, word in words:
-            addr = dictionary.lookup(word,ztext)
-            if not addr:
-                addr = 0
-            self.story.game_memory.set_word(idx, addr)
-            idx+=2
-            self.story.game_memory[idx] = len(word)
-            idx+=1
-            self.story.game_memory[idx] = offset+1
-            idx+=1
-
-        return True
+        values = [len(tokens)]
+        for addr,length,offset in tokens:
+            values.extend((addr,length,offset+1))
+        return struct.pack('>B' + ('HBB' * len(tokens)),*values)
 
     def show_status(self):
-        """ Update the statushow_statuss line with our current status """
-        # 8.2.2
-        routine = self.current_routine()
-        current_obj_id = routine.get_nth_global(0)
-        if not self.story.object_table.is_valid_object_id(current_obj_id):
-            room_name = 'INVALID OBJECT'
-        else:
-            current_obj = self.story.object_table[current_obj_id]
-            room_name,next_address = self.get_ztext().to_ascii(current_obj['short_name_zc'])
+        """ Update the status line with our current status """
+        # 8.2.2 -- location, score/hours and turns/minutes are the first three globals
+        raw_data = self.story.raw_data._raw_data
+        globals_address = self.story.header.global_variables_address
+        current_obj_id = (raw_data[globals_address] << 8) | raw_data[globals_address+1]
+        value_1 = (raw_data[globals_address+2] << 8) | raw_data[globals_address+3]
+        value_2 = (raw_data[globals_address+4] << 8) | raw_data[globals_address+5]
+        room_name = self._status_room_name(current_obj_id)
 
         if self.story.header.flag_status_line_type == 0:
             # 8.2.3.1
-            self.output_streams.show_status(room_name,score_mode=True,score=routine.get_nth_global(1),turns=routine.get_nth_global(2))
+            self.output_streams.show_status(room_name,score_mode=True,score=value_1,turns=value_2)
         else:
             # 8.2.3.2
-            self.output_streams.show_status(room_name,score_mode=False,hours=routine.get_nth_global(1),minutes=routine.get_nth_global(2))
+            self.output_streams.show_status(room_name,score_mode=False,hours=value_1,minutes=value_2)
+
+    def _status_room_name(self,obj_id):
+        """ Return the short name of the room for the status line. Names are cached by object id and the
+            bytes of the short name, since the room rarely changes between moves """
+        object_table = self.story.object_table
+        if obj_id < 1 or obj_id > object_table.number_of_objects():
+            return 'INVALID OBJECT'
+        index = object_table.get_property_index(obj_id)
+        address = index['short_name_address']
+        key = (obj_id,bytes(self.story.raw_data._raw_data[address:address+index['short_name_length']]))
+        room_name = self._status_names.get(key)
+        if room_name is None:
+            room_name,next_address = self.get_ztext().to_ascii(self.story.raw_data,address,index['short_name_length'])
+            self._status_names[key] = room_name
+        return room_name
 
     def quit(self):
         raise QuitException()
 
     def restart(self):
-        raise RestartException(self.story)
+        """ Restart the game in place. Dynamic memory is put back from the original story data and the call
+            stack starts over. Bits 0 and 1 of flags 2 are preserved (6.1.3). The story structures, caches
+            and streams are all kept, so nothing needs to be reloaded. Stream selection is kept too: the
+            transcript bit survives the restart, and a command file carries on from its next line """
+        if self.output_streams:
+            self.output_streams.flush()
+        flags_2 = self.story.raw_data[Header.FLAGS_2] & 0x03
+        self.story.reset_dynamic_memory()
+        self.story.raw_data[Header.FLAGS_2] = (self.story.raw_data[Header.FLAGS_2] & 0xFC) | flags_2
+        self.story.object_table.refresh_tree_mirror()
+
+        self.pc = self.story.header.main_routine_addr
+        self.last_instruction = None
+        self.routines = []
+        self.state = Interpreter.RUNNING_STATE
+        self._visited_addresses = {}
+        self._text_buffer_addr = None
+        self._parse_buffer_addr = None
+        self._undo = None
+        self.call_routine(self.pc,self.pc,None,None)
 
     def save(self,branch_offset,next_address):
         """ Handle a save. Branch info is used to move pc post save """
@@ -1181,49 +1573,147 @@ class Interpreter(object):
         }
         return data
 
-    def restore_from_save_data(self, data):
-        """ Reset this zmachine (preserving a few flags) from save data. Raises InvalidSaveDataException exception if issues. """
+    def to_binary_save_data(self):
+        """ Convert this zmachine into compact binary save data for persisting (see zmachine.savedata) """
+        static_address = self.story.header.static_memory_address
+        return encode_save(self._get_save_checksum(),
+                           self.state,
+                           self.pc,
+                           self._text_buffer_addr,
+                           self._parse_buffer_addr,
+                           [r.to_dict() for r in self.routines],
+                           self.story.raw_data._raw_data[0:static_address],
+                           self.story.story_data[0:static_address])
+
+    def to_delta_save_data(self,base_memory):
+        """ Convert this zmachine into a binary save holding only the changes since the state with dynamic memory
+            base_memory (see dynamic_memory) """
+        return encode_delta_save(base_memory,
+                                 self._get_save_checksum(),
+                                 self.state,
+                                 self.pc,
+                                 self._text_buffer_addr,
+                                 self._parse_buffer_addr,
+                                 [r.to_dict() for r in self.routines],
+                                 self.dynamic_memory())
+
+    def to_chunked_save_data(self,chunk_store):
+        """ Convert this zmachine into a chunked save, with the pages of dynamic memory put in chunk_store (see
+            zmachine.chunkstore). Pages already in the store aren't stored again """
+        return encode_chunked_save(chunk_store,
+                                   self._get_save_checksum(),
+                                   self.state,
+                                   self.pc,
+                                   self._text_buffer_addr,
+                                   self._parse_buffer_addr,
+                                   [r.to_dict() for r in self.routines],
+                                   self.dynamic_memory())
+
+    def dynamic_memory(self):
+        """ Return a copy of the current dynamic memory """
+        return bytes(self.story.raw_data._raw_data[0:self.story.header.static_memory_address])
+
+    def restore_from_save_data(self, data, base_memory=None, chunk_store=None):
+        """ Reset this zmachine (preserving a few flags) from save data, either binary (from to_binary_save_data,
+            to_delta_save_data or to_chunked_save_data) or JSON (from to_save_data). Restoring a delta needs 
+            base_memory, the dynamic memory of its base state, and restoring a chunked save needs the chunk_store
+            its pages were put in. Raises InvalidSaveDataException exception if issues. 
+            
+            Only dynamic memory and the call stack are replaced. The story is not reset, so the header,
+            dictionary, object table, caches and RNG are kept. """
         try:
-            parsed = json.loads(data)
+            if is_chunked_save(data):
+                parsed = decode_save(data,self.story.story_data,chunk_store)
+            elif is_delta_save(data):
+                if base_memory is None:
+                    raise InvalidSaveDataException('Delta save restored without its base state.')
+                parsed = decode_save(data,base_memory)
+            elif is_binary_save(data):
+                parsed = decode_save(data,self.story.story_data)
+            else:
+                parsed = json.loads(data)
             if parsed.get('version') != 1:
                 raise InvalidSaveDataException('Unsupported save version.')
             #print('"%s" vs "%s"' % (parsed.get('checksum'), self._get_save_checksum()))
             if parsed.get('checksum') != self._get_save_checksum():
                 raise InvalidSaveDataException('Unsupported save checksum.')
     
+            mem = bytes(parsed['dynamic_memory'])
+            if len(mem) > self.story.header.static_memory_address:
+                raise InvalidSaveDataException('Saved memory is longer than dynamic memory.')
+
             # Preserve value of flags 2 (6.1.2)
             flags_2 = self.story.raw_data[Header.FLAGS_2]
 
-            # Reset the story to initial values
-            self.reset(restoring=True)
-
             # Restore state
             self.state = parsed['state']
+            self.last_instruction = None
+            self._visited_addresses = {}
+            self._undo = None
 
             # Setup routines
-            self.routines = []
-            for routine in parsed['routines']:
-                self.routines.append(Routine(self.story.raw_data, 
-                            self.story.header.global_variables_address,
-                            0,
-                            0,
-                            0,
-                            0,
-                            0,
-                            data=routine))
-            # Restore memory
-            mem = parsed['dynamic_memory']
-            for idx in range(0,len(mem)):
-                self.story.raw_data._raw_data[idx] = mem[idx] 
+            self.routines = [self._copy_routine(self.story,routine) for routine in parsed['routines']]
+
+            # Restore memory. The story structures built on reset only depend on static memory, so they 
+            # (and the caches) are kept
+            self.story.reset_dynamic_memory(mem)
 
             # Set the flags to the saved state
             self.story.raw_data[Header.FLAGS_2] = flags_2
+            self.story.object_table.refresh_tree_mirror()
 
             self.pc = parsed['pc']
-            self._parse_buffer_addr = int(parsed.get('parse_buffer_addr','0'))
-            self._text_buffer_addr = int(parsed.get('text_buffer_addr','0'))
-        except IndexError as e:
+            self._parse_buffer_addr = self._optional_int(parsed.get('parse_buffer_addr'))
+            self._text_buffer_addr = self._optional_int(parsed.get('text_buffer_addr'))
+        except (IndexError,KeyError) as e:
             raise InvalidSaveDataException('Save data missing parameter: %s' % e)
+        except SaveDataException as e:
+            raise InvalidSaveDataException(str(e))
         except ValueError:
             raise InvalidSaveDataException('File does not contain valid json')
+
+    def enable_undo(self,max_snapshots=UndoBuffer.DEFAULT_SIZE):
+        """ Start keeping in-memory snapshots for undo, holding at most max_snapshots. Any existing snapshots
+            are dropped """
+        self._undo = UndoBuffer(self.story.raw_data._raw_data,
+                                self.story.header.static_memory_address,
+                                max_snapshots)
+
+    def take_snapshot(self):
+        """ Take an undo snapshot of the current state (usually just before processing a move). Only the pages
+            of dynamic memory changed since the last snapshot are stored """
+        if not self._undo:
+            self.enable_undo()
+        self._undo.push((self.pc,
+                         self.state,
+                         self._text_buffer_addr,
+                         self._parse_buffer_addr,
+                         [dict(r.to_dict(),local_variables=list(r.local_variables),stack=list(r.stack)) 
+                          for r in self.routines]))
+
+    def undo_depth(self):
+        """ Return the number of snapshots available to undo to """
+        return len(self._undo) if self._undo else 0
+
+    def undo(self,count=1):
+        """ Rewind to the count-th most recent snapshot (1 is the most recent), dropping it and any after it.
+            Flags 2 is preserved (6.1.2). Return False if there aren't that many snapshots """
+        if not self._undo:
+            return False
+        flags_2 = self.story.raw_data[Header.FLAGS_2]
+        snapshot = self._undo.pop(count)
+        if snapshot is None:
+            return False
+        self.pc,self.state,self._text_buffer_addr,self._parse_buffer_addr,routines = snapshot
+        self.routines = [self._copy_routine(self.story,routine) for routine in routines]
+        self.story.raw_data[Header.FLAGS_2] = flags_2
+        self.story.object_table.refresh_tree_mirror()
+        self.last_instruction = None
+        self._visited_addresses = {}
+        return True
+
+    def _optional_int(self,val):
+        if val is None:
+            return None
+        return int(val)
  
\ No newline at end of file
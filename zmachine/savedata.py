@@ -0,0 +1,205 @@
+""" Compact binary save format, in the spirit of Quetzal (http://inform-fiction.org/zmachine/standards/quetzal/).
+
+    Dynamic memory is stored XORed against the original story data and run-length encoded, so only the bytes
+    the game has changed take up space (see Quetzal 3.2). Routines are packed with struct.
+
+    A delta save stores memory against the memory of an earlier (base) state instead of the original story, so
+    a save made after one move only holds what that move changed. It is the delta magic and a CRC-32 of the
+    base memory, followed by a save in the layout below.
+
+    A chunked save stores dynamic memory as a list of page digests, with the pages themselves kept once each in a
+    chunk store (see zmachine.chunkstore). It is the chunked magic, the page size and count and the 20 byte
+    digest of each page, followed by a save in the layout below with no memory.
+
+    Layout (all values big-endian):
+        header      magic, format version, story checksum, state, pc, text buffer address, parse buffer
+                    address, dynamic memory length, compressed memory length, routine count
+        memory      compressed dynamic memory
+        routines    for each routine: routine start, return to address, code starts at, store to, version,
+                    local count, stack count, then the locals and the stack as 4-byte signed values
+"""
+import json
+import re
+import struct
+import zlib
+
+MAGIC = b'MZSV'
+DELTA_MAGIC = b'MZSD'
+CHUNKED_MAGIC = b'MZSP'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('>4sB8sBIHHIIH')
+DELTA_HEADER = struct.Struct('>4sI')
+CHUNKED_HEADER = struct.Struct('>4sHH')
+DIGEST_SIZE = 20 # SHA-1
+PAGE_SIZE = 256
+ROUTINE = struct.Struct('>IIIHBBH')
+
+NO_VALUE = 0xFFFF # Stored for addresses/variables that are None
+
+ZERO_RUN_RE = re.compile(b'\x00{1,256}')
+
+class SaveDataException(Exception):
+    """ Thrown when save data can't be decoded """
+    pass
+
+def is_binary_save(data):
+    """ Return True if data is in the binary save format (as opposed to the older JSON), including deltas """
+    return isinstance(data,(bytes,bytearray)) and data[0:len(MAGIC)] in (MAGIC,DELTA_MAGIC,CHUNKED_MAGIC)
+
+def is_delta_save(data):
+    """ Return True if data is a delta save, which needs the memory of its base state to restore """
+    return isinstance(data,(bytes,bytearray)) and data[0:len(DELTA_MAGIC)] == DELTA_MAGIC
+
+def is_chunked_save(data):
+    """ Return True if data is a chunked save, which needs the chunk store holding its pages to restore """
+    return isinstance(data,(bytes,bytearray)) and data[0:len(CHUNKED_MAGIC)] == CHUNKED_MAGIC
+
+def xor_bytes(a,b):
+    """ XOR two byte strings of the same length """
+    return (int.from_bytes(a,'big') ^ int.from_bytes(b,'big')).to_bytes(len(a),'big')
+
+def compress_memory(memory,original):
+    """ Compress memory against the original data it started as. Memory is XORed against the original,
+        then each run of up to 256 zeros is stored as a zero followed by the run length - 1. Trailing
+        zeros are dropped. See Quetzal 3.2 """
+    changes = xor_bytes(bytes(memory),bytes(original[0:len(memory)])).rstrip(b'\x00')
+    return ZERO_RUN_RE.sub(lambda m: b'\x00' + bytes((len(m.group(0))-1,)),changes)
+
+def decompress_memory(data,original):
+    """ Reverse compress_memory, returning a bytearray the same length as original """
+    changes = bytearray()
+    idx = 0
+    while idx < len(data):
+        zero_idx = data.find(b'\x00',idx)
+        if zero_idx < 0:
+            changes += data[idx:]
+            break
+        changes += data[idx:zero_idx]
+        if zero_idx+1 >= len(data):
+            raise SaveDataException('Compressed memory ends in the middle of a run')
+        changes += bytes(data[zero_idx+1]+1)
+        idx = zero_idx+2
+    if len(changes) > len(original):
+        raise SaveDataException('Compressed memory is longer than dynamic memory')
+    changes += bytes(len(original)-len(changes))
+    return bytearray(xor_bytes(bytes(changes),bytes(original)))
+
+def _to_word(val):
+    if val is None:
+        return NO_VALUE
+    return val
+
+def _from_word(val):
+    if val == NO_VALUE:
+        return None
+    return val
+
+def encode_save(checksum,state,pc,text_buffer_addr,parse_buffer_addr,routines,memory,original):
+    """ Return binary save data. checksum is the hex string from Interpreter._get_save_checksum, routines
+        a list of Routine.to_dict() results and original the original contents of memory """
+    compressed = compress_memory(memory,original)
+    chunks = [HEADER.pack(MAGIC,FORMAT_VERSION,bytes.fromhex(checksum),state,pc,
+                          _to_word(text_buffer_addr),_to_word(parse_buffer_addr),
+                          len(memory),len(compressed),len(routines)),
+              compressed]
+    for routine in routines:
+        local_variables,stack = routine['local_variables'],routine['stack']
+        chunks.append(ROUTINE.pack(routine['routine_start'],routine['return_to_address'],routine['code_starts_at'],
+                                   _to_word(routine['store_to']),routine['version'],len(local_variables),len(stack)))
+        chunks.append(struct.pack('>%di' % (len(local_variables)+len(stack)),*(local_variables+stack)))
+    return b''.join(chunks)
+
+def encode_delta_save(base_memory,checksum,state,pc,text_buffer_addr,parse_buffer_addr,routines,memory):
+    """ Return a delta save of memory against base_memory, the dynamic memory of an earlier state """
+    return DELTA_HEADER.pack(DELTA_MAGIC,zlib.crc32(bytes(base_memory))) + \
+           encode_save(checksum,state,pc,text_buffer_addr,parse_buffer_addr,routines,memory,base_memory)
+
+def encode_chunked_save(chunk_store,checksum,state,pc,text_buffer_addr,parse_buffer_addr,routines,memory,
+                        page_size=PAGE_SIZE):
+    """ Return a chunked save, putting the pages of memory into chunk_store """
+    pages = [bytes(memory[idx:idx+page_size]) for idx in range(0,len(memory),page_size)]
+    digests = chunk_store.put_many(pages)
+    return CHUNKED_HEADER.pack(CHUNKED_MAGIC,page_size,len(pages)) + b''.join(digests) + \
+           encode_save(checksum,state,pc,text_buffer_addr,parse_buffer_addr,routines,b'',b'')
+
+def decode_save(data,original,chunk_store=None):
+    """ Decode binary save data into a dict with the same keys as Interpreter.to_save_data. dynamic_memory
+        is a bytearray. original is the story data, or for a delta save the dynamic memory of its base state.
+        A chunked save needs the chunk_store holding its pages. Raises SaveDataException if the data is invalid """
+    if is_chunked_save(data):
+        if chunk_store is None:
+            raise SaveDataException('Chunked save restored without its chunk store.')
+        try:
+            magic,page_size,page_count = CHUNKED_HEADER.unpack_from(data,0)
+        except struct.error as e:
+            raise SaveDataException('Save data is truncated: %s' % e)
+        idx = CHUNKED_HEADER.size
+        if len(data) < idx + (page_count*DIGEST_SIZE):
+            raise SaveDataException('Save data is truncated.')
+        digests = [bytes(data[idx+(i*DIGEST_SIZE):idx+((i+1)*DIGEST_SIZE)]) for i in range(0,page_count)]
+        parsed = decode_save(data[idx+(page_count*DIGEST_SIZE):],b'')
+        parsed['dynamic_memory'] = bytearray(b''.join(chunk_store.get_many(digests)))
+        return parsed
+    if is_delta_save(data):
+        try:
+            magic,base_crc = DELTA_HEADER.unpack_from(data,0)
+        except struct.error as e:
+            raise SaveDataException('Save data is truncated: %s' % e)
+        if zlib.crc32(bytes(original)) != base_crc:
+            raise SaveDataException('Delta save does not match its base state.')
+        data = data[DELTA_HEADER.size:]
+    try:
+        magic,format_version,checksum,state,pc,text_buffer_addr,parse_buffer_addr,memory_length,\
+            compressed_length,routine_count = HEADER.unpack_from(data,0)
+        if magic != MAGIC:
+            raise SaveDataException('Not a binary save file.')
+        if format_version != FORMAT_VERSION:
+            raise SaveDataException('Unsupported save format version %d.' % format_version)
+        idx = HEADER.size
+        compressed = bytes(data[idx:idx+compressed_length])
+        if len(compressed) != compressed_length:
+            raise SaveDataException('Save data is truncated.')
+        idx += compressed_length
+
+        routines = []
+        for i in range(0,routine_count):
+            routine_start,return_to_address,code_starts_at,store_to,version,local_count,stack_count = \
+                ROUTINE.unpack_from(data,idx)
+            idx += ROUTINE.size
+            values = list(struct.unpack_from('>%di' % (local_count+stack_count),data,idx))
+            idx += 4 * (local_count+stack_count)
+            routines.append({'routine_start': routine_start,
+                             'local_variables': values[0:local_count],
+                             'stack': values[local_count:],
+                             'return_to_address': return_to_address,
+                             'store_to': _from_word(store_to),
+                             'version': version,
+                             'code_starts_at': code_starts_at})
+    except struct.error as e:
+        raise SaveDataException('Save data is truncated: %s' % e)
+
+    return {'version': 1,
+            'checksum': checksum.hex().upper(),
+            'routines': routines,
+            'state': state,
+            'pc': pc,
+            'text_buffer_addr': _from_word(text_buffer_addr),
+            'parse_buffer_addr': _from_word(parse_buffer_addr),
+            'dynamic_memory': decompress_memory(compressed,original[0:memory_length])}
+
+def save_dynamic_memory(data,original,base_memory=None,chunk_store=None):
+    """ Return the dynamic memory stored in save data of any kind (JSON, binary, delta or chunked). base_memory is 
+        needed for deltas, and chunk_store for chunked saves """
+    if is_chunked_save(data):
+        return decode_save(data,original,chunk_store)['dynamic_memory']
+    if is_delta_save(data):
+        if base_memory is None:
+            raise SaveDataException('Delta save restored without its base state.')
+        return decode_save(data,base_memory)['dynamic_memory']
+    if is_binary_save(data):
+        return decode_save(data,original)['dynamic_memory']
+    try:
+        return bytearray(json.loads(data)['dynamic_memory'])
+    except (ValueError,KeyError,TypeError):
+        raise SaveDataException('Save data is not valid.')
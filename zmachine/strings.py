@@ -0,0 +1,90 @@
+""" Static index of the strings in a story file, built without running the story.
+
+    Strings are found by walking the reachable code (for print/print_ret literals and print_paddr/print_addr
+    targets with constant addresses), plus the object short names and the abbreviation table.
+"""
+
+from zmachine.text import ZTextException,ZCharRegion
+from zmachine.instructions import walk_code,op_print,op_print_ret,op_print_paddr,op_print_addr,\
+                                  OperandTypeHint
+
+class StringIndex(object):
+    """ Maps text to the addresses it is stored at (and back). Built once from a reset story """
+    LITERAL = 'literal'           # Inline text of a print or print_ret instruction
+    ADDRESS = 'address'           # Target of a print_paddr/print_addr with a constant address
+    OBJECT_NAME = 'object'        # Short name of an object (12.4)
+    ABBREVIATION = 'abbreviation' # Entry in the abbreviations table (3.3)
+
+    def __init__(self,story,ztext):
+        self.story = story
+        self.ztext = ztext
+        self.entries = {}    # address -> (kind,text)
+        self.addresses = {}  # text -> list of addresses
+        self._region = ZCharRegion(story.raw_data)
+        self._load()
+        self._region = None
+
+    def _load(self):
+        header = self.story.header
+        memory = self.story.raw_data
+        instructions,routines = walk_code(memory,header.main_routine_addr,header.version)
+        for address in sorted(instructions):
+            instruction = instructions[address]
+            handler_f = instruction['handler']['handler']
+            if handler_f in (op_print,op_print_ret):
+                self._add_string(instruction['literal_address'],StringIndex.LITERAL)
+            elif handler_f in (op_print_paddr,op_print_addr):
+                val,hint = instruction['operands'][0]
+                if hint in (OperandTypeHint.packed_address,OperandTypeHint.address):
+                    self._add_string(val,StringIndex.ADDRESS)
+
+        object_table = self.story.object_table
+        for obj_id in range(1,object_table.number_of_objects()+1):
+            start_addr = object_table._obj_start_addr(obj_id)
+            property_address = memory.word(start_addr+object_table.PROPERTY_ADDRESS_OFFSET)
+            # 12.4 -- short name is a length byte (in words) followed by the ztext
+            text_length = memory[property_address]
+            if text_length:
+                self._add_string(property_address+1,StringIndex.OBJECT_NAME,text_length*2)
+
+        if header.version > 1:
+            abbrev_count = 96 if header.version > 2 else 32
+            for i in range(0,abbrev_count):
+                # 3.3, 1.2.2 (word address = address / 2)
+                self._add_string(memory.word(header.abbrev_address + (i*2))*2,StringIndex.ABBREVIATION)
+
+    def _add_string(self,address,kind,length_in_bytes=0):
+        if address in self.entries or address >= len(self.story.raw_data):
+            return
+        try:
+            zchars,next_address = self._region.zchars_at(address,length_in_bytes)
+            text = self.ztext.zchars_to_ascii(zchars)
+        except (ZTextException,IndexError):
+            return # Not valid ztext, so not something the story can print
+        self.entries[address] = (kind,text)
+        self.addresses.setdefault(text,[]).append(address)
+
+    def addresses_for(self,text):
+        """ Return the addresses the exact text is stored at, or an empty list """
+        return self.addresses.get(text,[])
+
+    def text_at(self,address):
+        """ Return the text stored at address, or None if no string is indexed there """
+        entry = self.entries.get(address)
+        if entry:
+            return entry[1]
+        return None
+
+    def search(self,fragment,ignore_case=True):
+        """ Return (address,kind,text) for each indexed string containing fragment, ordered by address """
+        if ignore_case:
+            fragment = fragment.lower()
+        results = []
+        for address in sorted(self.entries):
+            kind,text = self.entries[address]
+            if fragment in (text.lower() if ignore_case else text):
+                results.append((address,kind,text))
+        return results
+
+    def __len__(self):
+        return len(self.entries)
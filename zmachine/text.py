@@ -1,4 +1,10 @@
 """ Handles ZChars/Zascii and the general text processing part of the Z-Machine """
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # Bulk unpacking falls back to decoding a word at a time
 
 class ZTextException(Exception):
     """ Thrown when ztext is invalid in some way """
@@ -14,6 +20,117 @@ class ZTextState(object):
 SHIFT_UP=4
 SHIFT_DOWN=5
 
+def unpack_zchars(data):
+    """ Unpack a bytes-like object of packed ztext words into a flat array of zchars (three per word) and an 
+        array of end bits (one per word), in a single pass. Requires NumPy """
+    words = numpy.frombuffer(bytes(data[0:len(data) & ~1]),dtype='>u2')
+    zchars = numpy.empty((len(words),3),dtype=numpy.uint8)
+    zchars[:,0] = (words >> 10) & 0x1F
+    zchars[:,1] = (words >> 5) & 0x1F
+    zchars[:,2] = words & 0x1F
+    return zchars.ravel(),(words & 0x8000) != 0
+
+class ZCharRegion(object):
+    """ A region of memory unpacked into zchars up front, for tools that decode many strings from the same
+        memory (every object name, every dictionary word, every string in the story). Strings can start at
+        any byte, so the region is unpacked once for each alignment, as needed. If NumPy is not installed 
+        strings are read a word at a time, as ZText.to_ascii does. """
+    def __init__(self,memory,start_address=0,end_address=None):
+        self.memory = memory
+        self.start_address = start_address
+        self.end_address = len(memory) if end_address is None else end_address
+        self._unpacked = {} # alignment -> (zchars,end word indexes)
+
+    def _get_unpacked(self,alignment):
+        unpacked = self._unpacked.get(alignment)
+        if unpacked is None:
+            zchars,end_bits = unpack_zchars(self.memory[self.start_address+alignment:self.end_address])
+            unpacked = self._unpacked[alignment] = (zchars,numpy.flatnonzero(end_bits))
+        return unpacked
+
+    def zchars_at(self,address,length_in_bytes=0):
+        """ Return the list of zchars for the string at address, and the address following it. If length_in_bytes
+            is > 0 read that many bytes, otherwise read until the end of string word """
+        if numpy is None:
+            return self._scalar_zchars_at(address,length_in_bytes)
+
+        offset = address - self.start_address
+        zchars,ends = self._get_unpacked(offset & 1)
+        word_idx = offset >> 1
+        if length_in_bytes > 0:
+            last_word_idx = word_idx + ((length_in_bytes+1) >> 1) - 1
+        else:
+            end_idx = numpy.searchsorted(ends,word_idx)
+            if end_idx < len(ends):
+                last_word_idx = int(ends[end_idx])
+            else:
+                last_word_idx = (len(zchars) // 3) - 1
+        return zchars[word_idx*3:(last_word_idx+1)*3].tolist(),address + ((last_word_idx-word_idx+1)*2)
+
+    def _scalar_zchars_at(self,address,length_in_bytes):
+        if length_in_bytes < 1:
+            l = self.end_address
+        else:
+            l = min(self.end_address,address+length_in_bytes)
+        chars = []
+        idx = address
+        while idx < l:
+            b0 = self.memory[idx]
+            b1 = self.memory[idx+1] if idx+1 < self.end_address else 0
+            chars.extend(((b0 & 0x7C)>>2,((0x03 & b0) << 3) | ((0xE0 & b1)>>5), b1 & 0x1F))
+            idx+=2
+            if length_in_bytes < 1 and b0 & 0x80:
+                break
+        return chars,idx
+
+def _build_encrypt_map(zchars):
+    # char -> (alphabet,zchar) for every char that can be encrypted
+    encrypt_map = {}
+    for alphabet in (0,1,2):
+        for pos,c in enumerate(zchars[alphabet]):
+            encrypt_map[c] = (alphabet,pos+6)
+    return encrypt_map
+
+@lru_cache(maxsize=1024)
+def encrypt_word(version,text):
+    """ Encrypt text for dictionary matching to a six-zchar string, returned as 4 bytes. See 3.7 
+        Results are memoized, as players tend to use the same few hundred words over and over """
+    if version == 1:
+        encrypt_map = ZText.ENCRYPT_MAP_V1
+    else:
+        encrypt_map = ZText.ENCRYPT_MAP
+
+    results = [5] * 6
+    idx = 0
+    previous_alphabet = 0
+    # Characters that are not mappable are skipped
+    for c in text.lower():
+        mapped = encrypt_map.get(c)
+        if mapped is None:
+            continue
+        alphabet,zchar = mapped
+        if alphabet == 2:
+            # 3.7.1
+            if version < 3 and previous_alphabet == alphabet:
+                results[idx-2] = 4
+            else:
+                results[idx]=SHIFT_DOWN
+                idx+=1
+        if idx < len(results):
+            results[idx] = zchar
+            previous_alphabet = alphabet
+        idx+=1
+        if idx >= len(results):
+            break
+
+    # Compress the 6 characters into 4 bytes
+    b1 = (results[0] << 2 & 0xff) | (results[1] >> 3)
+    b2 = (results[1] << 5 & 0xff) | results[2]
+    b3 = (results[3] << 2 & 0xff) | (results[4] >> 3) | 0x80 # End flag always set on terminating word
+    b4 = (results[4] << 5 & 0xff) | results[5]
+
+    return bytes((b1,b2,b3,b4))
+
 class ZText(object):
     """ Abstraction for handling Z-Machine text. """
     ZCHARS    = [['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z'],
@@ -26,13 +143,29 @@ class ZText(object):
                       'U', 'Y', 'a', 'e', 'i', 'o', 'u', 'A', 'E', 'I', 'O', 'U', 'a', 'e', 'i', 'o', 'u', 'A', 'E', 'I', 'O', 'U', 'a', 'A', 'o', 'O', 
                       'a', 'n', 'o', 'A', 'N', 'O', 'ae', 'AE', 'c', 'C', 'th', 'th', 'Th', 'Th', 'L', 'oe', 'OE', '!', '?']
     SPACE = 32
+    ENCRYPT_MAP    = _build_encrypt_map(ZCHARS)
+    ENCRYPT_MAP_V1 = _build_encrypt_map(ZCHARS_V1)
 
     def __init__(self,version,get_abbrev_f,debug=False):
         self.version = version
         self.get_abbrev_f = get_abbrev_f
         self.debug=debug
+        # Version-specific tables, bound once
+        if version == 1:
+            self._zchars = ZText.ZCHARS_V1
+        else:
+            self._zchars = ZText.ZCHARS
+        self._abbrev_ztext = None # Decoder for abbreviation text, created on first abbreviation
+        self._abbreviations = {}  # abbreviation index -> text. Abbreviations are assumed not to change
         self.reset()
 
+    def fork(self,get_abbrev_f):
+        """ Return a new decoder sharing this one's abbreviation cache. Decoding state isn't shared, so the
+            two can be used from different threads """
+        other = ZText(version=self.version,get_abbrev_f=get_abbrev_f,debug=self.debug)
+        other._abbreviations = self._abbreviations
+        return other
+
     def reset(self):
         self._current_alphabet = 0
         self._shift_alphabet = None
@@ -43,7 +176,8 @@ class ZText(object):
         """ Convert the ztext starting at start_at in memory to an ascii string.
             Return the ascii text as well as the final memory offset
             If length_in_bytes > 0, convert that many bytes. Otherwise convert until the end of 
-            string word is found """
+            string word is found. Decoding always starts from a reset state """
+        self.reset()
         chars,idx = self._extract_zchars(memory,start_at,length_in_bytes)
         output_chars = self._handle_zchars(chars)
         if self.debug:
@@ -51,6 +185,12 @@ class ZText(object):
 
         return ''.join(output_chars),idx
 
+    def zchars_to_ascii(self,zchars):
+        """ Convert a list of zchars (such as from ZCharRegion.zchars_at) to an ascii string, starting from
+            a reset state """
+        self.reset()
+        return ''.join(self._handle_zchars(zchars))
+
     def _extract_zchars(self,memory,start_at,length_in_bytes):
         if length_in_bytes < 1:
             l = 100000000000
@@ -85,57 +225,7 @@ class ZText(object):
             and 3.7.1
             """
         if text == None: text = ''
-        text = text.lower()
-
-        if self.version==1:
-            valid_chars = ZText.ZCHARS_V1
-        else:
-            valid_chars = ZText.ZCHARS
-        
-        # Strip out any characters that are not mappable
-        new_text = ''
-        for c in text:
-            if c in valid_chars[0] or c in valid_chars[1] or c in valid_chars[2]:
-                new_text += c
-        text = new_text
-
-        results = [5] * 6
-        i = 0
-        idx = 0
-        mapping = ZText.ZCHARS
-        if self.version == 1:
-            mapping = ZText.ZCHARS_V1
-        previous_alphabet = 0
-        while i < min(len(text),6):
-            c = text[i]
-            for alphabet in (0,1,2):
-                try:
-                    pos = mapping[alphabet].index(c)
-                    if alphabet == 2:
-                        # 3.7.1
-                        if self.version < 3 and previous_alphabet == alphabet:
-                            results[idx-2] = 4
-                        else:
-                            results[idx]=SHIFT_DOWN
-                            idx+=1
-                    if idx >= len(results):
-                        break
-                    results[idx] = pos+6
-                    previous_alphabet = alphabet
-                except ValueError:
-                   pass 
-            i+=1
-            idx+=1
-            if idx >= len(results):
-                break
-
-        # Compress the 6 characters into 4 bytes
-        b1 = (results[0] << 2 & 0xff) | (results[1] >> 3)
-        b2 = (results[1] << 5 & 0xff) | results[2]
-        b3 = (results[3] << 2 & 0xff) | (results[4] >> 3) | 0x80 # End flag always set on terminating word
-        b4 = (results[4] << 5 & 0xff) | results[5]
-
-        return bytearray([b1,b2,b3,b4])
+        return bytearray(encrypt_word(self.version,text))
 
     def handle_zchar(self,zchar):
         """ Handle the given zcode based on our state and other information. 
@@ -218,10 +308,7 @@ class ZText(object):
             return '\n'
         # 3.5.3
         if zchar >= 6 and zchar < 32:
-            mapping = ZText.ZCHARS
-            if self.version == 1:
-                mapping = ZText.ZCHARS_V1
-            return mapping[self.alphabet][zchar-6]
+            return self._zchars[self.alphabet][zchar-6]
 
         return ''
 
@@ -242,9 +329,14 @@ class ZText(object):
 
 
     def _waiting_for_abbreviation(self,zchar):
-        ztext = ZText(version=self.version,get_abbrev_f=None)
         self.state = ZTextState.DEFAULT
-        text,offset= ztext.to_ascii(self.get_abbrev_f((32 * (self._previous_zchar-1)) + zchar),0,0)
+        index = (32 * (self._previous_zchar-1)) + zchar
+        text = self._abbreviations.get(index)
+        if text is None:
+            if not self._abbrev_ztext:
+                self._abbrev_ztext = ZText(version=self.version,get_abbrev_f=None)
+            text,offset = self._abbrev_ztext.to_ascii(self.get_abbrev_f(index),0,0)
+            self._abbreviations[index] = text
         return text
 
     @property
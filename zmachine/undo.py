@@ -0,0 +1,69 @@
+""" In-memory snapshots of a running interpreter, for undo and rewinding through history.
+
+    Each snapshot only holds the pages of dynamic memory that changed since the snapshot before it, plus a copy
+    of the call stack, so memory use is proportional to what each move changed.
+"""
+from collections import deque
+
+class UndoBuffer(object):
+    """ Bounded ring buffer of snapshots of dynamic memory and interpreter state. Once full, the oldest
+        snapshot is dropped.
+
+        A shadow copy of memory always matches the most recent snapshot. Each snapshot records the previous
+        contents of the pages that changed since the snapshot before it, so rewinding copies back only
+        those pages. """
+    PAGE_SIZE = 256
+    DEFAULT_SIZE = 50
+
+    def __init__(self,memory,dynamic_length,max_snapshots=DEFAULT_SIZE):
+        self.memory = memory # Live memory, as a bytearray
+        self.dynamic_length = dynamic_length
+        self._shadow = bytearray(memory[0:dynamic_length])
+        self._snapshots = deque(maxlen=max_snapshots)
+
+    def _changed_pages(self):
+        """ Return the start of each page that differs between memory and the shadow copy """
+        memory,shadow = self.memory,self._shadow
+        changed = []
+        for start in range(0,self.dynamic_length,UndoBuffer.PAGE_SIZE):
+            end = min(start+UndoBuffer.PAGE_SIZE,self.dynamic_length)
+            if memory[start:end] != shadow[start:end]:
+                changed.append(start)
+        return changed
+
+    def push(self,state):
+        """ Take a snapshot of memory, along with state (anything the caller needs to restore it) """
+        pages = []
+        for start in self._changed_pages():
+            end = min(start+UndoBuffer.PAGE_SIZE,self.dynamic_length)
+            pages.append((start,bytes(self._shadow[start:end])))
+            self._shadow[start:end] = self.memory[start:end]
+        self._snapshots.append((pages,state))
+
+    def pop(self,count=1):
+        """ Put memory back as it was at the count-th most recent snapshot (1 is the most recent), and drop
+            that snapshot and any after it. Return the state stored with it, or None if there aren't that
+            many snapshots """
+        if count < 1 or count > len(self._snapshots):
+            return None
+
+        # Back to the most recent snapshot
+        for start in self._changed_pages():
+            end = min(start+UndoBuffer.PAGE_SIZE,self.dynamic_length)
+            self.memory[start:end] = self._shadow[start:end]
+
+        for i in range(0,count):
+            pages,state = self._snapshots.pop()
+            for start,old_page in pages:
+                # The shadow moves back to the snapshot before this one. Memory stops at the one asked for
+                self._shadow[start:start+len(old_page)] = old_page
+                if i < count-1:
+                    self.memory[start:start+len(old_page)] = old_page
+        return state
+
+    def clear(self):
+        self._snapshots.clear()
+        self._shadow[:] = self.memory[0:self.dynamic_length]
+
+    def __len__(self):
+        return len(self._snapshots)